@@ -0,0 +1,93 @@
+"""
+Tests of mixcloud.aio, imported by tests.py on Python 3.7 and later.
+"""
+import asyncio
+import mixcloud
+import unittest
+from mixcloud.aio import AsyncMixcloud
+
+
+class FakeAioResponse(object):
+
+    status = 200
+
+    def __init__(self, data):
+        self.data = data
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        pass
+
+    async def json(self, content_type=None):
+        return self.data
+
+
+class FakeAioSession(object):
+
+    def __init__(self, routes):
+        self.routes = routes
+        self.requests = []
+
+    def get(self, url, params=None):
+        self.requests.append((url, params))
+        return FakeAioResponse(self.routes[url])
+
+
+class TestAsyncMixcloud(unittest.TestCase):
+
+    def setUp(self):
+        root = mixcloud.API_ROOT
+        user = {'username': 'spartacus', 'name': 'Spartacus'}
+        cc = {'slug': 'party-time',
+              'name': 'Party Time',
+              'tags': [{'name': 'Funk'}],
+              'user': user,
+              'created_time': '2009-08-02T16:55:01Z',
+              }
+        full_cc = dict(cc,
+                       description='Bla bla',
+                       sections=[{'start_time': 0,
+                                  'track': {'name': 'Samurai',
+                                            'artist': {'slug': 'jazztronik',
+                                                       'name': 'Jazztronik',
+                                                       },
+                                            },
+                                  }],
+                       )
+        next_url = root + '/spartacus/cloudcasts/?offset=1'
+        self.session = FakeAioSession({
+            root + '/spartacus': user,
+            root + '/spartacus/cloudcasts/': {'data': [cc],
+                                              'paging': {'next': next_url},
+                                              },
+            next_url: {'data': [cc], 'paging': {}},
+            root + '/spartacus/party-time': full_cc,
+        })
+        self.m = AsyncMixcloud(session=self.session)
+
+    def testUserAndCloudcasts(self):
+        async def run():
+            u = await self.m.user('spartacus')
+            ccs = [cc async for cc in self.m.cloudcasts(u)]
+            await self.m.load(ccs[0])
+            return u, ccs
+
+        u, ccs = asyncio.run(run())
+        self.assertIsInstance(u, mixcloud.User)
+        self.assertEqual(u.name, 'Spartacus')
+        self.assertEqual([cc.key for cc in ccs], ['party-time'] * 2)
+        self.assertEqual(ccs[0].description(), 'Bla bla')
+        self.assertEqual(ccs[0].sections()[0].track.name, 'Samurai')
+        with self.assertRaises(TypeError):
+            ccs[1].sections()
+
+    def testCloudcastsLimit(self):
+        async def run():
+            return [cc async for cc in self.m.cloudcasts('spartacus',
+                                                         limit=1)]
+
+        ccs = asyncio.run(run())
+        self.assertEqual(len(ccs), 1)
+        self.assertEqual(len(self.session.requests), 1)
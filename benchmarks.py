@@ -0,0 +1,470 @@
+"""
+Benchmarks for the mixcloud bindings, run offline on a synthetic catalog.
+Requests are answered by mixcloud.mock.MockServer.
+
+    python benchmarks.py [--cloudcasts N] [--baseline FILE] [name ...]
+
+Each benchmark prints one JSON object per line. With --baseline, the
+output of a previous run, each rate is also compared to the one found
+there (in a "change" member, as a ratio).
+"""
+import argparse
+import collections
+import datetime
+import gc
+import io
+import json
+import platform
+import random
+import sys
+import timeit
+import tracemalloc
+
+import dateutil.parser
+import httpretty
+import yaml
+
+import mixcloud
+import mixcloud.multipart
+from mixcloud.mock import MockServer, parse_multipart
+
+
+def synthetic_catalog(n_users=1000, n_cloudcasts=5000, n_sections=15,
+                      n_artists=2000, seed=0):
+    """
+    Return a list of cloudcasts as decoded from /{user}/{cloudcast}.
+    Artists and tags are drawn from small pools, as in real catalogs.
+    """
+    rng = random.Random(seed)
+    users = [{'username': 'user-%d' % i, 'name': 'User %d' % i}
+             for i in range(n_users)]
+    artists = [{'slug': 'artist-%d' % i, 'name': 'Artist %d' % i}
+               for i in range(n_artists)]
+    tags = ['Tag %d' % i for i in range(50)]
+    start = datetime.datetime(2010, 1, 1)
+    catalog = []
+    for i in range(n_cloudcasts):
+        created = start + datetime.timedelta(minutes=17 * i)
+        catalog.append({
+            'slug': 'show-%d' % i,
+            'name': 'Show %d' % i,
+            'description': 'Description of show %d' % i,
+            'user': dict(rng.choice(users)),
+            'tags': [{'name': t} for t in rng.sample(tags, 3)],
+            'created_time': created.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'pictures': {'large': 'http://example.com/%d.jpg' % i},
+            'sections': [{'start_time': 180 * n,
+                          'track': {'name': 'Track %d' % rng.randrange(5000),
+                                    'artist': dict(rng.choice(artists)),
+                                    },
+                          }
+                         for n in range(n_sections)],
+        })
+    return catalog
+
+
+def _allocated(f):
+    """
+    Call f and return its result and the memory it holds on to, in bytes.
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = f()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+
+# The models as they were before __slots__, as a baseline for
+# bench_memory: every instance has a __dict__.
+
+class _DictArtist(collections.namedtuple('_Artist', 'key name')):
+    pass
+
+
+class _DictTrack(collections.namedtuple('_Track', 'name artist')):
+    pass
+
+
+class _DictSection(collections.namedtuple('_Section', 'start_time track')):
+    pass
+
+
+def _dict_section(d):
+    track = d['track']
+    artist = _DictArtist(track['artist']['slug'], track['artist']['name'])
+    return _DictSection(d['start_time'], _DictTrack(track['name'], artist))
+
+
+class _DictUser(object):
+
+    def __init__(self, key, name, m=None):
+        self.m = m
+        self.key = key
+        self.name = name
+
+
+class _DictCloudcast(object):
+
+    def __init__(self, key, name, sections, tags,
+                 description, user, created_time, pictures=None, m=None):
+        self.key = key
+        self.name = name
+        self.tags = tags
+        self._description = description
+        self._sections = sections
+        self.user = user
+        self.created_time = created_time
+        self.m = m
+        self.pictures = pictures
+
+    @staticmethod
+    def from_json(d):
+        sections = [_dict_section(s) for s in d['sections']]
+        user = _DictUser(d['user']['username'], d['user']['name'])
+        return _DictCloudcast(d['slug'], d['name'], sections,
+                              [t['name'] for t in d['tags']],
+                              d.get('description'), user,
+                              mixcloud.parse_datetime(d['created_time']),
+                              pictures=d.get('pictures'))
+
+
+def bench_memory(catalog):
+    """
+    Memory held by decoded cloudcasts: with models without __slots__
+    (dict), with the current models (plain), and with the artists and users
+    interned by a client. slots_saving is the saving of plain over dict,
+    saving the one of interned over plain, total_saving the one of
+    interned over dict.
+    """
+    # Decode from fresh copies, as if the JSON came from the network.
+    data = json.dumps(catalog)
+    m = mixcloud.Mixcloud()
+
+    def dicts():
+        return [_DictCloudcast.from_json(d) for d in json.loads(data)]
+
+    def plain():
+        return [mixcloud.Cloudcast.from_json(d) for d in json.loads(data)]
+
+    def interned():
+        return [mixcloud.Cloudcast.from_json(d, m=m)
+                for d in json.loads(data)]
+
+    _, dict_bytes = _allocated(dicts)
+    _, plain_bytes = _allocated(plain)
+    _, interned_bytes = _allocated(interned)
+    n = len(catalog)
+    return {'dict_bytes_per_cloudcast': dict_bytes / n,
+            'plain_bytes_per_cloudcast': plain_bytes / n,
+            'interned_bytes_per_cloudcast': interned_bytes / n,
+            'slots_saving': 1 - float(plain_bytes) / dict_bytes,
+            'saving': 1 - float(interned_bytes) / plain_bytes,
+            'total_saving': 1 - float(interned_bytes) / dict_bytes,
+            }
+
+
+def bench_lazy_listing(catalog):
+    """
+    Decoding speed of a listing, eager or lazy, when only key, name and
+    created_time are read, and the memory then held. Lazy cloudcasts hold
+    on to their JSON, so they are faster to decode but larger.
+    """
+    keys = ['slug', 'name', 'tags', 'user', 'created_time', 'pictures']
+    data = json.dumps([{k: d[k] for k in keys} for d in catalog])
+    m = mixcloud.Mixcloud()
+
+    def decode(lazy):
+        ccs = [mixcloud.Cloudcast.from_json(d, m=m, lazy=lazy)
+               for d in json.loads(data)]
+        for cc in ccs:
+            cc.key, cc.name, cc.created_time
+        return ccs
+
+    _, eager_bytes = _allocated(lambda: decode(False))
+    _, lazy_bytes = _allocated(lambda: decode(True))
+    n = len(catalog)
+    return {'eager_retained_bytes_per_cloudcast': eager_bytes / n,
+            'lazy_retained_bytes_per_cloudcast': lazy_bytes / n,
+            'eager_per_s': _rate(lambda: decode(False), n),
+            'lazy_per_s': _rate(lambda: decode(True), n),
+            }
+
+
+def _rate(f, n, repeat=3):
+    """
+    Best throughput of f, which processes n items, in items per second.
+    """
+    return n / min(timeit.repeat(f, number=1, repeat=repeat))
+
+
+def bench_timestamps(catalog):
+    """
+    Throughput of mixcloud.parse_datetime compared to dateutil.
+    """
+    stamps = [d['created_time'] for d in catalog]
+    assert all(mixcloud.parse_datetime(s) == dateutil.parser.parse(s)
+               for s in stamps)
+    fast = _rate(lambda: [mixcloud.parse_datetime(s) for s in stamps],
+                 len(stamps))
+    slow = _rate(lambda: [dateutil.parser.parse(s) for s in stamps],
+                 len(stamps))
+    return {'parse_datetime_per_s': fast,
+            'dateutil_per_s': slow,
+            'speedup': fast / slow,
+            }
+
+
+def bench_slugify(catalog):
+    """
+    Throughput of slugify on the artist names of the catalog: without the
+    cache, with a warm cache, and through slugify_many.
+    """
+    names = [s['track']['artist']['name']
+             for d in catalog for s in d['sections']]
+    uncached = mixcloud.slugify.__wrapped__
+
+    def many():
+        mixcloud.slugify.cache_clear()
+        return mixcloud.slugify_many(names)
+
+    return {'uncached_per_s': _rate(lambda: [uncached(n) for n in names],
+                                    len(names)),
+            'cached_per_s': _rate(lambda: [mixcloud.slugify(n)
+                                           for n in names],
+                                  len(names)),
+            'slugify_many_per_s': _rate(many, len(names)),
+            }
+
+
+def bench_decode(catalog):
+    """
+    Decoding throughput of full cloudcasts (Cloudcast.from_json) and of
+    their tracklists alone (Section.list_from_json).
+    """
+    m = mixcloud.Mixcloud()
+    n_sections = sum(len(d['sections']) for d in catalog)
+
+    def sections():
+        for d in catalog:
+            mixcloud.Section.list_from_json(d['sections'], m=m)
+
+    return {'cloudcasts_per_s': _rate(
+                lambda: [mixcloud.Cloudcast.from_json(d, m=m)
+                         for d in catalog], len(catalog)),
+            'sections_per_s': _rate(sections, n_sections),
+            }
+
+
+def _single_user(catalog, n):
+    """
+    The first n cloudcasts of the catalog, as uploaded by a single user.
+    """
+    user = {'username': 'bench', 'name': 'Bench'}
+    return 'bench', [dict(d, user=user) for d in catalog[:n]]
+
+
+def _serve(cloudcasts):
+    httpretty.reset()
+    httpretty.enable()
+    MockServer().register_catalog(cloudcasts)
+
+
+def bench_listing(catalog, n=5000, page_size=50):
+    """
+    Throughput of a paginated listing of n cloudcasts, served by the mock
+    server, with and without prefetching.
+    """
+    user, ccs = _single_user(catalog, n)
+    n = len(ccs)
+    _serve(ccs)
+    try:
+        m = mixcloud.Mixcloud()
+        u = m.user(user)
+
+        def listing(prefetch, lazy=False):
+            found = list(u.iter_cloudcasts(page_size=page_size,
+                                           prefetch=prefetch, lazy=lazy))
+            assert len(found) == n
+        return {'on_demand_per_s': _rate(lambda: listing(0), n),
+                'prefetch_per_s': _rate(lambda: listing(1), n),
+                'lazy_per_s': _rate(lambda: listing(0, lazy=True), n),
+                'page_size': page_size,
+                }
+    finally:
+        httpretty.disable()
+        httpretty.reset()
+
+
+def _hydration_rates(m, u, n):
+    def sequential():
+        for cc in u.cloudcasts(limit=n):
+            cc.sections()
+
+    def concurrent():
+        failures = m.hydrate(u.cloudcasts(limit=n))
+        assert not failures
+    return _rate(sequential, n), _rate(concurrent, n)
+
+
+def bench_hydration(catalog, n=200, latency=0.005):
+    """
+    Throughput of loading the sections of listed cloudcasts: one at a time
+    through Cloudcast.sections() (lazy loads), or with Mixcloud.hydrate.
+    This is measured with httpretty, and over HTTP against a local server
+    adding latency to each response.
+    """
+    user, ccs = _single_user(catalog, n)
+    n = len(ccs)
+    _serve(ccs)
+    try:
+        m = mixcloud.Mixcloud()
+        sequential, concurrent = _hydration_rates(m, m.user(user), n)
+    finally:
+        httpretty.disable()
+        httpretty.reset()
+    with MockServer(listen=True) as mc:
+        mc.register_catalog(ccs)
+        mc.set_latency(latency)
+        with mixcloud.Mixcloud(api_root=mc.api_root) as m:
+            http_sequential, http_concurrent = \
+                _hydration_rates(m, m.user(user), n)
+    return {'sequential_per_s': sequential,
+            'hydrate_per_s': concurrent,
+            'http_sequential_per_s': http_sequential,
+            'http_hydrate_per_s': http_concurrent,
+            'latency': latency,
+            }
+
+
+def bench_yaml(catalog, n=500):
+    """
+    Parsing throughput of YAML tracklists, in shows and sections per
+    second.
+    """
+    docs = [{'title': d['name'],
+             'desc': d['description'],
+             'tags': [t['name'] for t in d['tags']],
+             'tracks': [{'start': s['start_time'],
+                         'artist': s['track']['artist']['name'],
+                         'track': s['track']['name'],
+                         }
+                        for s in d['sections']],
+             }
+            for d in catalog[:n]]
+    n = len(docs)
+    single = yaml.safe_dump(docs[0])
+    stream = yaml.safe_dump_all(docs)
+    user = mixcloud.User('bench', 'Bench')
+    n_sections = sum(len(d['tracks']) for d in docs)
+
+    def parse():
+        found = list(mixcloud.Cloudcast.iter_from_yml(io.StringIO(stream),
+                                                      user))
+        assert len(found) == n
+    shows_per_s = _rate(parse, n)
+    return {'shows_per_s': shows_per_s,
+            'sections_per_s': shows_per_s * n_sections / n,
+            'from_yml_per_s': _rate(
+                lambda: mixcloud.Cloudcast.from_yml(single, user), 1,
+                repeat=100),
+            }
+
+
+def bench_upload_body(catalog, size=32 * 1024 * 1024):
+    """
+    Encoding throughput of an upload body with a file of size bytes, read
+    as requests does, and parsing throughput of the mock server.
+    """
+    cc = mixcloud.Cloudcast.from_json(catalog[0])
+    mp3 = io.BytesIO(b'\x00' * size)
+
+    def encode():
+        body = mixcloud.multipart.MultipartBody(
+            mixcloud.upload_payload(cc), {'mp3': mp3})
+        while body.read(body.chunk_size):
+            pass
+        mp3.seek(0)
+        return body
+    body = encode()
+    total = len(body)
+    body.reset()
+    data = b''.join(iter(lambda: body.read(body.chunk_size), b''))
+    mp3.seek(0)
+    return {'bytes_per_s': _rate(encode, total),
+            'parse_bytes_per_s': _rate(lambda: parse_multipart(data), total),
+            'payloads_per_s': _rate(lambda: mixcloud.upload_payload(cc), 1,
+                                    repeat=100),
+            }
+
+
+BENCHMARKS = {
+    'decode': bench_decode,
+    'hydration': bench_hydration,
+    'lazy_listing': bench_lazy_listing,
+    'listing': bench_listing,
+    'memory': bench_memory,
+    'slugify': bench_slugify,
+    'timestamps': bench_timestamps,
+    'upload_body': bench_upload_body,
+    'yaml': bench_yaml,
+}
+
+
+def load_results(f):
+    """
+    Read the output of a previous run, by benchmark name.
+    """
+    results = {}
+    for line in f:
+        if line.strip():
+            result = json.loads(line)
+            results[result['benchmark']] = result
+    return results
+
+
+def compare(result, baseline):
+    """
+    Ratios of the rates of result to the ones of baseline (above 1 is
+    faster).
+    """
+    return {k: v / baseline[k] for k, v in result.items()
+            if k.endswith('_per_s') and baseline.get(k)}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help=', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--cloudcasts', type=int, default=5000)
+    parser.add_argument('--sections', type=int, default=15)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', type=argparse.FileType('r'))
+    args = parser.parse_args(argv)
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: {}'.format(name))
+    baseline = load_results(args.baseline) if args.baseline else {}
+    catalog = synthetic_catalog(n_users=args.users,
+                                n_cloudcasts=args.cloudcasts,
+                                n_sections=args.sections, seed=args.seed)
+    meta = {'python': platform.python_version(),
+            'cloudcasts': args.cloudcasts,
+            'users': args.users,
+            'sections': args.sections,
+            }
+    for name in args.names or sorted(BENCHMARKS):
+        result = BENCHMARKS[name](catalog)
+        if name in baseline:
+            result['change'] = compare(result, baseline[name])
+        result['benchmark'] = name
+        result.update(meta)
+        print(json.dumps(result, sort_keys=True))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,15 +1,31 @@
+import bisect
 import collections
+import concurrent.futures
+import datetime
 import dateutil.parser
+import dateutil.tz
+import functools
+import json
+import mixcloud.jsonstream
+import mixcloud.metrics
+import mixcloud.multipart
+import mixcloud.ratelimit
 import netrc
+import random
 import re
 import requests
+import requests.adapters
+import threading
+import time
 import unidecode
 import yaml
 
 try:
+    import queue
     from urllib.parse import urlencode
 except ImportError:
     # Python 2 fallback.
+    import Queue as queue
     from urllib import urlencode
     FileNotFoundError = IOError
 
@@ -23,6 +39,24 @@ class MixcloudOauthError(Exception):
     pass
 
 
+class MixcloudYamlError(Exception):
+    """
+    A YAML tracklist is malformed.
+    """
+    pass
+
+
+class MixcloudRateLimitError(Exception):
+    """
+    The server kept answering 429 Too Many Requests. retry_after is the
+    delay it asked for, in seconds, if any.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super(MixcloudRateLimitError, self).__init__(message)
+        self.retry_after = retry_after
+
+
 def setup_yaml():
     def construct_yaml_str(self, node):
         # Override the default string handling function
@@ -33,21 +67,79 @@ def setup_yaml():
     yaml.SafeLoader.add_constructor(tag, construct_yaml_str)
 
 
+class YamlLoader(getattr(yaml, 'CSafeLoader', yaml.SafeLoader)):
+    """
+    Safe YAML loader for tracklists. It uses libyaml when it is available,
+    and always returns unicode strings (like setup_yaml, but without
+    changing the global loaders).
+    """
+    pass
+
+
+YamlLoader.add_constructor(u'tag:yaml.org,2002:str',
+                           lambda loader, node: loader.construct_scalar(node))
+
+
+def netrc_access_token():
+    """
+    Look up an access token for NETRC_MACHINE in the user's netrc file.
+    Return None if there is none.
+    """
+    try:
+        # Check there is a netrc file.
+        netrc_auth = netrc.netrc()
+    except FileNotFoundError:
+        return None
+    try:
+        # Attempt netrc lookup.
+        credentials = netrc_auth.authenticators(NETRC_MACHINE)
+        if netrc_auth:
+            return credentials[2]
+    except netrc.NetrcParseError:
+        # Configuration errors unrelated to the Mixcloud entry
+        # will cause this exception to be thrown, whether or not
+        # there is a Mixcloud entry.
+        pass
+    return None
+
+
+def upload_payload(cloudcast):
+    """
+    Form fields describing cloudcast, as expected by the upload endpoint.
+    """
+    payload = {'name': cloudcast.name,
+               'percentage_music': 100,
+               'description': cloudcast.description(),
+               }
+    for num, sec in enumerate(cloudcast.sections()):
+        payload['sections-%d-artist' % num] = sec.track.artist.name
+        payload['sections-%d-song' % num] = sec.track.name
+        payload['sections-%d-start_time' % num] = sec.start_time
+
+    for num, tag in enumerate(cloudcast.tags):
+        payload['tags-%s-tag' % num] = tag
+    return payload
+
+
 class MixcloudOauth(object):
     """
     Assists in the OAuth dance with Mixcloud to get an access token.
     """
 
-    def __init__(self, client_id=None, client_secret=None, redirect_uri=None):
+    def __init__(self, client_id=None, client_secret=None, redirect_uri=None,
+                 session=None, oauth_root=OAUTH_ROOT):
         self.client_id = client_id
         self.client_secret = client_secret
         self.redirect_uri = redirect_uri
+        # Any object with a requests-like get(), such as Mixcloud.session.
+        self.session = session
+        self.oauth_root = oauth_root
 
     def authorize_url(self):
         """
         Return a URL to redirect the user to for OAuth authentication.
         """
-        auth_url = OAUTH_ROOT + '/authorize'
+        auth_url = self.oauth_root + '/authorize'
         params = {
             'client_id': self.client_id,
             'redirect_uri': self.redirect_uri,
@@ -58,92 +150,456 @@ class MixcloudOauth(object):
         """
         Exchange the authorization code for an access token.
         """
-        access_token_url = OAUTH_ROOT + '/access_token'
+        access_token_url = self.oauth_root + '/access_token'
         params = {
             'client_id': self.client_id,
             'client_secret': self.client_secret,
             'redirect_uri': self.redirect_uri,
             'code': code,
         }
-        resp = requests.get(access_token_url, params=params)
+        http = self.session if self.session is not None else requests
+        resp = http.get(access_token_url, params=params)
         if not resp.ok:
             raise MixcloudOauthError("Could not get access token.")
         return resp.json()['access_token']
 
 
 class Mixcloud(object):
+    """
+    Client for the Mixcloud API.
+
+    Every request made by the client, and by the User and Cloudcast objects
+    it creates, goes through a single pool of keep-alive connections.
+    Each thread gets its own requests.Session, but all of them are mounted
+    on the same adapter so that connections are shared. The client can be
+    used as a context manager, or closed explicitly with close().
 
-    def __init__(self, api_root=API_ROOT, access_token=None):
+    pool_connections is the number of hosts to keep pools for, pool_maxsize
+    the number of connections kept per host. With pool_block, no more than
+    pool_maxsize connections are opened to a host at once.
+
+    cache is an optional mixcloud.cache.ResponseCache shared by all the
+    GET requests of the client.
+
+    store is an optional mixcloud.store.MetadataStore. Users and full
+    cloudcasts are looked up there before hitting the network, and saved
+    there once fetched.
+
+    rate_limiter is an optional mixcloud.ratelimit.RateLimiter that every
+    request goes through. It slows down when the server answers 429, and
+    such requests are retried. Without it, a 429 raises
+    MixcloudRateLimitError.
+
+    The artists, users and tags decoded by a client are shared between the
+    objects it returns, see Interner.
+
+    Hooks are called around every request, see add_hook. metrics is an
+    optional mixcloud.metrics.Metrics, which is installed as a 'response'
+    hook.
+    """
+
+    def __init__(self, api_root=API_ROOT, access_token=None,
+                 pool_connections=10, pool_maxsize=10, pool_block=False,
+                 keep_alive=True, timeout=None, cache=None, store=None,
+                 rate_limiter=None, metrics=None):
         self.api_root = api_root
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.interner = Interner()
+        self.cache = cache
+        self.store = store
+        self.keep_alive = keep_alive
+        self._adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+        )
+        self._local = threading.local()
         if access_token is None:
-            try:
-                # Check there is a netrc file.
-                netrc_auth = netrc.netrc()
-            except FileNotFoundError:
-                pass
-            else:
-                try:
-                    # Attempt netrc lookup.
-                    credentials = netrc_auth.authenticators(NETRC_MACHINE)
-                    if netrc_auth:
-                        access_token = credentials[2]
-                except netrc.NetrcParseError:
-                    # Configuration errors unrelated to the Mixcloud entry
-                    # will cause this exception to be thrown, whether or not
-                    # there is a Mixcloud entry.
-                    pass
+            access_token = netrc_access_token()
         self.access_token = access_token
+        self.hooks = {'request': [], 'response': []}
+        self.metrics = metrics
+        if metrics is not None:
+            self.add_hook('response', metrics)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def session(self):
+        """
+        The requests.Session of the calling thread.
+        """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self._adapter)
+            session.mount('https://', self._adapter)
+            if not self.keep_alive:
+                session.headers['Connection'] = 'close'
+            self._local.session = session
+        return session
+
+    def close(self):
+        """
+        Close all pooled connections.
+        """
+        self._adapter.close()
+
+    def add_hook(self, event, hook):
+        """
+        Call hook with a mixcloud.metrics.RequestInfo before ('request') or
+        after ('response') every HTTP request, including retries. Hooks are
+        called from the thread making the request.
+        """
+        self.hooks[event].append(hook)
+
+    def remove_hook(self, event, hook):
+        self.hooks[event].remove(hook)
+
+    def _send(self, method, url, endpoint, lazy_load, retries, **kwargs):
+        """
+        Make one request, and call the hooks around it.
+        """
+        if not self.hooks['request'] and not self.hooks['response']:
+            return self.session.request(method, url, timeout=self.timeout,
+                                        **kwargs)
+        body = kwargs.get('data')
+        info = mixcloud.metrics.RequestInfo(
+            method, url, endpoint=endpoint, lazy_load=lazy_load,
+            retries=retries,
+            bytes_sent=len(body) if hasattr(body, '__len__') else 0)
+        for hook in self.hooks['request']:
+            hook(info)
+        start = mixcloud.ratelimit.monotonic()
+        try:
+            r = self.session.request(method, url, timeout=self.timeout,
+                                     **kwargs)
+        except Exception as e:
+            info.error = e
+            raise
+        else:
+            info.status = r.status_code
+            if kwargs.get('stream'):
+                length = r.headers.get('Content-Length')
+                if length is not None:
+                    info.bytes_received = int(length)
+            else:
+                info.bytes_received = len(r.content)
+            return r
+        finally:
+            info.elapsed = mixcloud.ratelimit.monotonic() - start
+            for hook in self.hooks['response']:
+                hook(info)
+
+    def _request(self, method, url, endpoint=None, lazy_load=False, attempt=0,
+                 **kwargs):
+        """
+        Make a request through the rate limiter, retrying on 429. endpoint
+        and lazy_load are passed to the hooks, as well as the number of
+        previous attempts, starting from attempt.
+        """
+        limiter = self.rate_limiter
+        retries = limiter.max_retries if limiter is not None else 0
+        for n in range(retries + 1):
+            if limiter is not None:
+                limiter.acquire()
+            r = self._send(method, url, endpoint, lazy_load, attempt + n,
+                           **kwargs)
+            if r.status_code != 429:
+                if limiter is not None:
+                    limiter.succeeded()
+                return r
+            retry_after = mixcloud.ratelimit.parse_retry_after(
+                r.headers.get('Retry-After'))
+            if limiter is not None:
+                limiter.throttled(retry_after)
+            if hasattr(kwargs.get('data'), 'reset'):
+                kwargs['data'].reset()
+        raise MixcloudRateLimitError('Rate limited on {}'.format(url),
+                                     retry_after=retry_after)
+
+    def _get(self, url, params=None, headers=None, endpoint=None,
+             lazy_load=False):
+        return self._request('GET', url, endpoint=endpoint,
+                             lazy_load=lazy_load, params=params,
+                             headers=headers)
+
+    def _get_json(self, endpoint, url, params=None, lazy_load=False,
+                  revalidate=False, check=False):
+        """
+        GET url and decode the response, going through the cache if there
+        is one. endpoint is the template of url, such as '/{user}'. With
+        revalidate, a cached response is only used after the server
+        confirmed it is still valid, even if it is fresh. With check, error
+        responses raise requests.HTTPError instead of being decoded.
+        """
+        cache = self.cache
+        if cache is None or not cache.ttl_for(endpoint):
+            r = self._get(url, params, endpoint=endpoint, lazy_load=lazy_load)
+            if check:
+                r.raise_for_status()
+            return r.json()
+        key = cache.key(url, params)
+        entry = cache.lookup(key)
+        if entry is not None and entry.fresh() and not revalidate:
+            return json.loads(entry.body.decode('utf-8'))
+        headers = entry.validators() if entry is not None else None
+        r = self._get(url, params, headers=headers, endpoint=endpoint,
+                      lazy_load=lazy_load)
+        if r.status_code == 304 and entry is not None:
+            cache.revalidated(key, endpoint, entry)
+            return json.loads(entry.body.decode('utf-8'))
+        if r.ok:
+            cache.store(key, endpoint, r.content, r.headers)
+        elif check:
+            r.raise_for_status()
+        return r.json()
+
+    def _post(self, url, **kwargs):
+        return self._request('POST', url, **kwargs)
+
+    def _stream_items(self, endpoint, url, params=None, members=None,
+                      chunk_size=16 * 1024):
+        """
+        GET url and yield the items of the data array of the response while
+        it is being downloaded. The other members of the response are
+        stored in members. The cache is not used.
+        """
+        r = self._request('GET', url, endpoint=endpoint, params=params,
+                          stream=True)
+        try:
+            chunks = r.iter_content(chunk_size)
+            for item in mixcloud.jsonstream.iter_items(chunks, 'data',
+                                                       members):
+                yield item
+        finally:
+            r.close()
 
     def artist(self, key):
         url = '{root}/artist/{key}'.format(root=self.api_root, key=key)
-        r = requests.get(url)
-        return Artist.from_json(r.json())
+        data = self._get_json('/artist/{key}', url)
+        return Artist.from_json(data)
+
+    def _user_json(self, key):
+        store = self.store
+        data = store.get_user(key) if store is not None else None
+        if data is None:
+            url = '{root}/{user}'.format(root=self.api_root, user=key)
+            data = self._get_json('/{user}', url)
+            if store is not None:
+                store.put_user(data)
+        return data
+
+    def _cloudcast_json(self, user, key, lazy_load=False):
+        store = self.store
+        data = store.get_cloudcast(user, key) if store is not None else None
+        if data is None:
+            url = '{root}/{user}/{cc}'.format(root=self.api_root,
+                                              user=user,
+                                              cc=key)
+            data = self._get_json('/{user}/{cloudcast}', url,
+                                  lazy_load=lazy_load, check=True)
+            if store is not None:
+                store.put_cloudcast(data)
+        return data
 
     def user(self, key):
-        url = '{root}/{user}'.format(root=self.api_root, user=key)
-        r = requests.get(url)
-        return User.from_json(r.json(), m=self)
+        data = self._user_json(key)
+        return User.from_json(data, m=self)
 
     def me(self):
         url = '{root}/me/'.format(root=self.api_root)
-        r = requests.get(url, {'access_token': self.access_token})
-        return User.from_json(r.json(), m=self)
+        params = {'access_token': self.access_token}
+        data = self._get_json('/me/', url, params)
+        return User.from_json(data, m=self)
 
-    def upload(self, cloudcast, mp3file, picturefile=None):
+    def hydrate(self, cloudcasts, max_workers=8):
+        """
+        Fetch the sections and description of many cloudcasts at once, with
+        at most max_workers requests in flight. Cloudcasts that are already
+        loaded are skipped.
+
+        A failure does not stop the others: the list of (cloudcast,
+        exception) pairs for the cloudcasts that could not be loaded is
+        returned.
+        """
+        todo = [cc for cc in cloudcasts if not cc._loaded()]
+        failures = []
+        if not todo:
+            return failures
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+            futures = [(cc, pool.submit(cc._load, lazy_load=False))
+                       for cc in todo]
+            for cc, future in futures:
+                error = future.exception()
+                if error is not None:
+                    failures.append((cc, error))
+        return failures
+
+    def upload(self, cloudcast, mp3file, picturefile=None, progress=None,
+               chunk_size=64 * 1024, retries=3, backoff=1.0, max_backoff=60.0,
+               throttle=None):
+        """
+        Upload a cloudcast and return an UploadResult. The files are
+        streamed chunk_size bytes at a time, see
+        mixcloud.multipart.MultipartBody for the progress and throttle
+        arguments.
+
+        Connection errors, timeouts, rate limiting and 5xx responses are
+        retried up to
+        retries times, waiting a random delay of up to backoff * 2 ** n
+        seconds (capped to max_backoff) before the nth retry. The files must
+        be seekable for that. So as not to upload the same show twice, a
+        retry is skipped when the cloudcast turns out to exist already, and
+        a retry is used up when that cannot be checked.
+        """
         url = '{root}/upload/'.format(root=self.api_root)
-        payload = {'name': cloudcast.name,
-                   'percentage_music': 100,
-                   'description': cloudcast.description(),
-                   }
-        for num, sec in enumerate(cloudcast.sections()):
-            payload['sections-%d-artist' % num] = sec.track.artist.name
-            payload['sections-%d-song' % num] = sec.track.name
-            payload['sections-%d-start_time' % num] = sec.start_time
-
-        for num, tag in enumerate(cloudcast.tags):
-            payload['tags-%s-tag' % num] = tag
+        payload = upload_payload(cloudcast)
 
         files = {'mp3': mp3file}
         if picturefile is not None:
             files['picture'] = picturefile
 
-        r = requests.post(url,
-                          data=payload,
-                          params={'access_token': self.access_token},
-                          files=files,
-                          )
-        return r
+        body = mixcloud.multipart.MultipartBody(payload, files,
+                                                chunk_size=chunk_size,
+                                                progress=progress,
+                                                throttle=throttle)
+        result = UploadResult(slugify(cloudcast.name))
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                delay = min(max_backoff, backoff * 2 ** (attempt - 1))
+                time.sleep(random.uniform(0, delay))
+                try:
+                    uploaded = self._uploaded(cloudcast, result.key)
+                except (requests.ConnectionError, requests.Timeout,
+                        MixcloudRateLimitError) as e:
+                    # Not known to exist: try again at the next retry.
+                    result.response = None
+                    result.error = e
+                    continue
+                if uploaded:
+                    result.existing = True
+                    break
+                body.reset()
+            result.attempts += 1
+            try:
+                r = self._post(url,
+                               endpoint='/upload/',
+                               attempt=attempt,
+                               data=body,
+                               params={'access_token': self.access_token},
+                               headers={'Content-Type': body.content_type},
+                               )
+            except (requests.ConnectionError, requests.Timeout,
+                    MixcloudRateLimitError) as e:
+                result.response = None
+                result.error = e
+                continue
+            result.response = r
+            result.error = None
+            if r.status_code < 500:
+                break
+        return result
+
+    def _uploaded(self, cloudcast, key):
+        """
+        Whether the cloudcast can be found on the server.
+        """
+        if cloudcast.user is not None:
+            user = cloudcast.user.key
+        else:
+            user = self.me().key
+        url = '{root}/{user}/{cc}'.format(root=self.api_root,
+                                          user=user,
+                                          cc=key)
+        return self._get(url,
+                         endpoint='/{user}/{cloudcast}').status_code == 200
 
     def upload_yml_file(self, ymlfile, mp3file):
         user = self.me()
         cloudcast = Cloudcast.from_yml(ymlfile, user)
-        r = self.upload(cloudcast, mp3file)
+        return self.upload(cloudcast, mp3file)
+
+
+class UploadResult(object):
+    """
+    Outcome of Mixcloud.upload.
+
+    key is the expected key of the cloudcast and attempts the number of
+    requests made. response is the last response, if any, and error the
+    exception raised by the last attempt. existing is set when a retry
+    found that the cloudcast had been created by an earlier attempt.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.attempts = 0
+        self.response = None
+        self.error = None
+        self.existing = False
+
+    @property
+    def ok(self):
+        return self.existing or (self.response is not None
+                                 and self.response.ok)
+
+    @property
+    def status_code(self):
+        if self.response is None:
+            return None
+        return self.response.status_code
+
+
+class Interner(object):
+    """
+    Hands out a single instance of each artist, user and tag, so that a
+    large catalog does not hold thousands of copies of the same ones.
+    """
+
+    def __init__(self):
+        self._artists = {}
+        self._users = {}
+        self._tags = {}
+
+    def __len__(self):
+        return len(self._artists) + len(self._users) + len(self._tags)
+
+    def artist(self, key, name):
+        k = (key, name)
+        artist = self._artists.get(k)
+        if artist is None:
+            artist = self._artists.setdefault(k, Artist(key, name))
+        return artist
+
+    def user(self, key, name, m=None):
+        k = (key, name)
+        user = self._users.get(k)
+        if user is None:
+            user = self._users.setdefault(k, User(key, name, m=m))
+        return user
+
+    def tag(self, name):
+        return self._tags.setdefault(name, name)
+
+    def clear(self):
+        self._artists.clear()
+        self._users.clear()
+        self._tags.clear()
 
 
 class Artist(collections.namedtuple('_Artist', 'key name')):
 
+    __slots__ = ()
+
     @staticmethod
-    def from_json(data):
+    def from_json(data, m=None):
+        if m is not None:
+            return m.interner.artist(data['slug'], data['name'])
         return Artist(data['slug'], data['name'])
 
     @staticmethod
@@ -153,6 +609,8 @@ class Artist(collections.namedtuple('_Artist', 'key name')):
 
 class User(object):
 
+    __slots__ = ('m', 'key', 'name')
+
     def __init__(self, key, name, m=None):
         self.m = m
         self.key = key
@@ -160,17 +618,21 @@ class User(object):
 
     @staticmethod
     def from_json(data, m=None):
+        if m is not None:
+            return m.interner.user(data['username'], data['name'], m=m)
         return User(data['username'], data['name'], m=m)
 
     def cloudcast(self, key):
-        url = '{root}/{user}/{cc}'.format(root=self.m.api_root,
-                                          user=self.key,
-                                          cc=key)
-        r = requests.get(url)
-        data = r.json()
-        return Cloudcast.from_json(data)
+        data = self.m._cloudcast_json(self.key, key)
+        return Cloudcast.from_json(data, m=self.m)
 
-    def cloudcasts(self, limit=None, offset=None):
+    def cloudcasts(self, limit=None, offset=None, eager=False, lazy=False):
+        """
+        Fetch a page of cloudcasts. Listings do not include sections and
+        descriptions; with eager, they are fetched concurrently (see
+        Mixcloud.hydrate) and failures are raised. With lazy, fields are
+        decoded on first access (see Cloudcast).
+        """
         url = '{root}/{user}/cloudcasts/'.format(root=self.m.api_root,
                                                  user=self.key)
         params = {}
@@ -178,12 +640,143 @@ class User(object):
             params['limit'] = limit
         if offset is not None:
             params['offset'] = offset
-        r = requests.get(url, params=params)
-        data = r.json()
-        return [Cloudcast.from_json(d, m=self.m) for d in data['data']]
+        data = self.m._get_json('/{user}/cloudcasts/', url, params=params)
+        ccs = [Cloudcast.from_json(d, m=self.m, lazy=lazy)
+               for d in data['data']]
+        if eager:
+            failures = self.m.hydrate(ccs)
+            if failures:
+                raise failures[0][1]
+        return ccs
+
+    def iter_cloudcasts(self, page_size=20, prefetch=1, max_items=None,
+                        created_before=None, created_after=None, lazy=False,
+                        stream=False):
+        """
+        Iterate over all the cloudcasts of the user, newest first.
+
+        Pages are fetched by following the paging.next links returned by
+        the API, so that uploads happening during the iteration do not shift
+        the results. While a page is being consumed, up to prefetch pages are
+        fetched in a background thread (0 fetches pages on demand).
+
+        Iteration stops after max_items cloudcasts, or at the first one
+        created at or before created_after. Cloudcasts created at or after
+        created_before are skipped.
+
+        lazy is passed to Cloudcast.from_json.
+
+        With stream, each page is decoded while it is being downloaded and
+        cloudcasts are yielded as soon as they are complete, so that only
+        one of them is held in memory at a time. Pages are not prefetched
+        in that case.
+        """
+        if stream:
+            items = self._stream_cloudcasts(page_size, lazy)
+        else:
+            pages = self._cloudcast_pages(page_size, max_items,
+                                          created_before, created_after,
+                                          lazy)
+            items = _flatten(_prefetch(pages, prefetch))
+        try:
+            n = 0
+            for cc in items:
+                if created_after is not None \
+                        and cc.created_time <= created_after:
+                    return
+                if created_before is not None \
+                        and cc.created_time >= created_before:
+                    continue
+                if max_items is not None and n >= max_items:
+                    return
+                n += 1
+                yield cc
+        finally:
+            items.close()
+
+    def _stream_cloudcasts(self, page_size, lazy):
+        url = '{root}/{user}/cloudcasts/'.format(root=self.m.api_root,
+                                                 user=self.key)
+        params = {'limit': page_size}
+        while url is not None:
+            members = {}
+            empty = True
+            for d in self.m._stream_items('/{user}/cloudcasts/', url,
+                                          params=params, members=members):
+                empty = False
+                yield Cloudcast.from_json(d, m=self.m, lazy=lazy)
+            if empty:
+                return
+            url = members.get('paging', {}).get('next')
+            params = None
+
+    def sync(self, since=None, page_size=20, lazy=False):
+        """
+        Fetch the cloudcasts uploaded since the last call. since is the
+        watermark returned by that call (None the first time, to get all
+        the cloudcasts).
+
+        Pages are read newest first and reading stops at the first
+        cloudcast created at or before since, so that nothing new costs a
+        single request. Return a SyncResult with the new cloudcasts, newest
+        first, and the watermark to pass next time.
+        """
+        new = list(self.iter_cloudcasts(page_size=page_size, prefetch=0,
+                                        created_after=since, lazy=lazy))
+        watermark = since
+        for cc in new:
+            if watermark is None or cc.created_time > watermark:
+                watermark = cc.created_time
+        return SyncResult(new, watermark)
+
+    def _cloudcast_pages(self, page_size, max_items, created_before,
+                         created_after, lazy):
+        """
+        Yield lists of cloudcasts, one per page, stopping as soon as the
+        stopping conditions of iter_cloudcasts are met.
+        """
+        url = '{root}/{user}/cloudcasts/'.format(root=self.m.api_root,
+                                                 user=self.key)
+        params = {'limit': page_size}
+        n = 0
+        while url is not None:
+            # New uploads must show up, so cached pages are revalidated.
+            data = self.m._get_json('/{user}/cloudcasts/', url,
+                                    params=params, revalidate=True)
+            page = [Cloudcast.from_json(d, m=self.m, lazy=lazy)
+                    for d in data['data']]
+            if not page:
+                return
+            yield page
+            if created_before is None:
+                n += len(page)
+            else:
+                n += sum(1 for cc in page
+                         if cc.created_time < created_before)
+            if max_items is not None and n >= max_items:
+                return
+            if created_after is not None \
+                    and page[-1].created_time <= created_after:
+                return
+            # The next URL already contains the query string.
+            url = data.get('paging', {}).get('next')
+            params = None
+
+
+SyncResult = collections.namedtuple('SyncResult', 'cloudcasts watermark')
 
 
 class Cloudcast(object):
+    """
+    A cloudcast. Cloudcasts decoded with lazy=True keep the JSON they come
+    from and only decode tags, user, created_time, pictures and sections
+    when they are first accessed. This makes decoding cheaper when few
+    fields are read, at the cost of keeping the JSON around.
+    """
+
+    __slots__ = ('key', 'name', '_tags', '_description', '_sections',
+                 '_user', '_created_time', 'm', '_pictures', '_data',
+                 '_timeline')
 
     def __init__(self, key, name, sections, tags,
                  description, user, created_time, pictures=None, m=None):
@@ -196,17 +789,27 @@ class Cloudcast(object):
         self.created_time = created_time
         self.m = m
         self.pictures = pictures
+        self._data = None
+        self._timeline = None
 
     @staticmethod
-    def from_json(d, m=None):
+    def from_json(d, m=None, lazy=False):
+        if lazy:
+            sections = _UNSET if 'sections' in d else None
+            cc = Cloudcast(d['slug'], d['name'], sections, _UNSET,
+                           d.get('description'), _UNSET, _UNSET,
+                           pictures=_UNSET, m=m)
+            cc._data = d
+            return cc
         if 'sections' in d:
-            sections = Section.list_from_json(d['sections'])
+            sections = Section.list_from_json(d['sections'], m=m)
         else:
             sections = None
         desc = d.get('description')
-        tags = [t['name'] for t in d['tags']]
-        user = User.from_json(d['user'])
-        created_time = dateutil.parser.parse(d['created_time'])
+        tags = _tags_from_json(d['tags'], m)
+        user = User.from_json(d['user'], m=m) if d['user'] else None
+        created_time = parse_datetime(d['created_time']) \
+            if d['created_time'] else None
         return Cloudcast(d['slug'],
                          d['name'],
                          sections,
@@ -218,20 +821,65 @@ class Cloudcast(object):
                          m=m,
                          )
 
-    def _load(self):
-        url = '{root}/{user}/{cc}'.format(root=self.m.api_root,
-                                          user=self.user.key,
-                                          cc=self.key)
-        r = requests.get(url)
-        d = r.json()
-        self._sections = Section.list_from_json(d['sections'])
+    @property
+    def tags(self):
+        if self._tags is _UNSET:
+            self._tags = _tags_from_json(self._data['tags'], self.m)
+        return self._tags
+
+    @tags.setter
+    def tags(self, value):
+        self._tags = value
+
+    @property
+    def user(self):
+        if self._user is _UNSET:
+            d = self._data['user']
+            self._user = User.from_json(d, m=self.m) if d else None
+        return self._user
+
+    @user.setter
+    def user(self, value):
+        self._user = value
+
+    @property
+    def created_time(self):
+        if self._created_time is _UNSET:
+            d = self._data['created_time']
+            self._created_time = parse_datetime(d) if d else None
+        return self._created_time
+
+    @created_time.setter
+    def created_time(self, value):
+        self._created_time = value
+
+    @property
+    def pictures(self):
+        if self._pictures is _UNSET:
+            self._pictures = self._data.get('pictures')
+        return self._pictures
+
+    @pictures.setter
+    def pictures(self, value):
+        self._pictures = value
+
+    def _load(self, lazy_load=True):
+        d = self.m._cloudcast_json(self.user.key, self.key,
+                                   lazy_load=lazy_load)
+        self._sections = Section.list_from_json(d['sections'], m=self.m)
         self._description = d['description']
 
+    def _loaded(self):
+        return self._sections is not None and self._description is not None
+
     def sections(self):
         """
         Depending on the data available when the instance was created,
         it may be necessary to fetch data.
         """
+        if self._sections is _UNSET:
+            self._sections = Section.list_from_json(self._data['sections'],
+                                                    m=self.m)
         if self._sections is None:
             self._load()
         return self._sections
@@ -247,30 +895,126 @@ class Cloudcast(object):
     def picture(self):
         return self.pictures['large']
 
+    def to_json(self):
+        """
+        Encode the cloudcast as the API does. The sections and description
+        are only included when they are known: no request is made.
+        """
+        user = self.user
+        d = {'slug': self.key,
+             'name': self.name,
+             'tags': [{'name': t} for t in self.tags],
+             'user': {'username': user.key,
+                      'name': user.name,
+                      } if user is not None else None,
+             'created_time': format_datetime(self.created_time),
+             'pictures': self.pictures,
+             }
+        if self._description is not None:
+            d['description'] = self._description
+        if self._sections is not None:
+            d['sections'] = [{'start_time': s.start_time,
+                              'track':
+                              {'name': s.track.name,
+                               'artist':
+                               {'slug': s.track.artist.key,
+                                'name': s.track.artist.name,
+                                },
+                               },
+                              }
+                             for s in self.sections()]
+        return d
+
+    def _sorted_sections(self):
+        """
+        The sections sorted by start time, along with the list of start
+        times. This is computed once per list of sections.
+        """
+        sections = self.sections()
+        timeline = self._timeline
+        if timeline is None or timeline[0] is not sections:
+            ordered = sorted(sections, key=lambda s: s.start_time)
+            starts = [s.start_time for s in ordered]
+            timeline = self._timeline = (sections, ordered, starts)
+        return timeline[1], timeline[2]
+
+    def section_at(self, t):
+        """
+        The section playing at second t, or None before the first one.
+        May hit server, see Cloudcast.sections.
+        """
+        ordered, starts = self._sorted_sections()
+        i = bisect.bisect_right(starts, t) - 1
+        if i < 0:
+            return None
+        return ordered[i]
+
+    def section_spans(self, length=None):
+        """
+        List of (section, end_time, duration) triples, sorted by start time.
+        A section ends when the next one starts; the last one ends at
+        length (the duration of the cloudcast in seconds) if it is known,
+        and its end and duration are None otherwise.
+        """
+        ordered, starts = self._sorted_sections()
+        ends = starts[1:] + [length]
+        return [(sec, end, end - sec.start_time if end is not None else None)
+                for sec, end in zip(ordered, ends)]
+
     @staticmethod
     def from_yml(f, user):
-        setup_yaml()
-        d = yaml.load(f)
-        name = d['title']
-        sections = [Section.from_yml(s) for s in d['tracks']]
+        """
+        Parse a show described in YAML (see README). Raise MixcloudYamlError
+        if it is malformed.
+        """
+        return Cloudcast.from_yml_dict(yaml.load(f, Loader=YamlLoader), user)
+
+    @staticmethod
+    def iter_from_yml(f, user):
+        """
+        Parse a stream of YAML documents, one show each, and yield them as
+        they are read.
+        """
+        for d in yaml.load_all(f, Loader=YamlLoader):
+            yield Cloudcast.from_yml_dict(d, user)
+
+    @staticmethod
+    def from_yml_dict(d, user):
+        if not isinstance(d, dict):
+            raise MixcloudYamlError('Expected a mapping')
+        try:
+            name = d['title']
+            tracks = d['tracks']
+            tags = d['tags']
+            description = d['desc']
+            sections = [Section.from_yml(s) for s in tracks]
+        except (KeyError, TypeError) as e:
+            raise MixcloudYamlError('Missing or invalid field: {}'.format(e))
+        _check_starts(name, sections)
         key = slugify(name)
-        tags = d['tags']
-        description = d['desc']
         created_time = None
         c = Cloudcast(key, name, sections, tags, description,
                       user, created_time)
         return c
 
 
+def _tags_from_json(tags, m):
+    if m is not None:
+        return [m.interner.tag(t['name']) for t in tags]
+    return [t['name'] for t in tags]
+
+
 class Section(collections.namedtuple('_Section', 'start_time track')):
 
+    __slots__ = ()
+
     @staticmethod
-    def from_json(d):
-        return Section(d['start_time'], Track.from_json(d['track']))
+    def from_json(d, m=None):
+        return Section(d['start_time'], Track.from_json(d['track'], m=m))
 
     @staticmethod
-    def list_from_json(d):
-        return [Section.from_json(s) for s in d]
+    def list_from_json(d, m=None):
+        return [Section.from_json(s, m=m) for s in d]
 
     @staticmethod
     def from_yml(d):
@@ -281,11 +1025,213 @@ class Section(collections.namedtuple('_Section', 'start_time track')):
 
 class Track(collections.namedtuple('_Track', 'name artist')):
 
+    __slots__ = ()
+
     @staticmethod
-    def from_json(d):
-        return Track(d['name'], Artist.from_json(d['artist']))
+    def from_json(d, m=None):
+        return Track(d['name'], Artist.from_json(d['artist'], m=m))
+
+
+def _check_starts(name, sections):
+    """
+    Make sure that start times are increasing numbers of seconds. Writing
+    1:25 instead of 85 is fine, but values like 1:75 are not numbers.
+    """
+    previous = None
+    for num, sec in enumerate(sections):
+        start = sec.start_time
+        if isinstance(start, bool) or not isinstance(start, int) \
+                or start < 0:
+            raise MixcloudYamlError(
+                '{}: track {}: invalid start {!r}'.format(name, num, start))
+        if previous is not None and start <= previous:
+            raise MixcloudYamlError(
+                '{}: track {}: start {} is not after {}'.format(
+                    name, num, start, previous))
+        previous = start
+
+
+_UTC = dateutil.tz.tzutc()
+
+
+def format_datetime(dt):
+    """
+    Inverse of parse_datetime. UTC timestamps use the format of the API.
+    """
+    if dt is None:
+        return None
+    if dt.utcoffset() == datetime.timedelta(0) and not dt.microsecond:
+        return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+    return dt.isoformat()
+
+
+def parse_datetime(s):
+    """
+    Parse a timestamp. The format used by the API, 2015-03-15T12:00:00Z,
+    is decoded directly; anything else goes through dateutil.
+    """
+    if len(s) == 20 and s[19] == 'Z' and s[10] == 'T' \
+            and s[4] == s[7] == '-' and s[13] == s[16] == ':':
+        try:
+            return datetime.datetime(int(s[0:4]), int(s[5:7]),
+                                     int(s[8:10]), int(s[11:13]),
+                                     int(s[14:16]), int(s[17:19]),
+                                     tzinfo=_UTC)
+        except ValueError:
+            pass
+    return dateutil.parser.parse(s)
+
+
+def sections_at(queries):
+    """
+    Answer many Cloudcast.section_at queries, given as (cloudcast, t)
+    pairs. Return the list of sections (or None) in the same order.
+    """
+    timelines = {}
+    result = []
+    for cloudcast, t in queries:
+        timeline = timelines.get(id(cloudcast))
+        if timeline is None:
+            timeline = timelines[id(cloudcast)] = \
+                cloudcast._sorted_sections()
+        ordered, starts = timeline
+        i = bisect.bisect_right(starts, t) - 1
+        result.append(ordered[i] if i >= 0 else None)
+    return result
+
+
+_DONE = object()
+_UNSET = object()
+
+
+def _flatten(iterables):
+    try:
+        for iterable in iterables:
+            for item in iterable:
+                yield item
+    finally:
+        iterables.close()
 
 
+def _prefetch(iterable, size):
+    """
+    Iterate over iterable in a background thread, keeping at most size
+    items ready ahead of the consumer. The thread stops when the returned
+    generator is closed.
+    """
+    if size <= 0:
+        for item in iterable:
+            yield item
+        return
+    results = queue.Queue()
+    # ahead[0] counts the items fetched but not consumed yet. The
+    # producer waits on cond for a free slot or for stop.
+    cond = threading.Condition()
+    ahead = [0]
+    stop = threading.Event()
+
+    def acquire():
+        with cond:
+            while ahead[0] >= size and not stop.is_set():
+                cond.wait()
+            ahead[0] += 1
+            return not stop.is_set()
+
+    def produce():
+        it = iter(iterable)
+        try:
+            while acquire():
+                try:
+                    item = next(it)
+                except StopIteration:
+                    results.put((_DONE, None))
+                    return
+                results.put((item, None))
+        except Exception as e:
+            results.put((_DONE, e))
+
+    t = threading.Thread(target=produce)
+    t.daemon = True
+    t.start()
+    try:
+        while True:
+            item, error = results.get()
+            if item is _DONE:
+                if error is not None:
+                    raise error
+                return
+            with cond:
+                ahead[0] -= 1
+                cond.notify()
+            yield item
+    finally:
+        with cond:
+            stop.set()
+            cond.notify()
+
+
+_SLUG_RE = re.compile(r'\W+')
+_ASCII_RE = re.compile(r'^[\x00-\x7f]*$')
+
+_CacheInfo = collections.namedtuple('CacheInfo',
+                                    'hits misses maxsize currsize')
+
+
+def _memoize(maxsize):
+    """
+    functools.lru_cache where available. On Python 2, a plain memo that is
+    emptied when it is full, with the same cache_info() and cache_clear().
+    """
+    if hasattr(functools, 'lru_cache'):
+        return functools.lru_cache(maxsize=maxsize)
+
+    def decorator(f):
+        memo = {}
+        stats = [0, 0]
+
+        def wrapper(arg):
+            try:
+                result = memo[arg]
+            except KeyError:
+                stats[1] += 1
+                if len(memo) >= maxsize:
+                    memo.clear()
+                result = memo[arg] = f(arg)
+            else:
+                stats[0] += 1
+            return result
+
+        def cache_clear():
+            memo.clear()
+            stats[:] = [0, 0]
+
+        wrapper.cache_info = lambda: _CacheInfo(stats[0], stats[1], maxsize,
+                                                len(memo))
+        wrapper.cache_clear = cache_clear
+        wrapper.__wrapped__ = f
+        return functools.update_wrapper(wrapper, f)
+    return decorator
+
+
+@_memoize(maxsize=4096)
 def slugify(s):
-    s = unidecode.unidecode(s).lower()
-    return re.sub(r'\W+', '-', s)
+    """
+    Turn a name into a key. Results are cached, see slugify.cache_info().
+    """
+    if not _ASCII_RE.match(s):
+        s = unidecode.unidecode(s)
+    return _SLUG_RE.sub('-', s.lower())
+
+
+def slugify_many(names):
+    """
+    Slugify a sequence of names, computing each distinct name only once.
+    """
+    seen = {}
+    slugs = []
+    for name in names:
+        slug = seen.get(name)
+        if slug is None:
+            slug = seen[name] = slugify(name)
+        slugs.append(slug)
+    return slugs
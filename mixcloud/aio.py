@@ -0,0 +1,203 @@
+"""
+Asyncio client for the Mixcloud API.
+
+This requires aiohttp, which can be installed with the "async" extra.
+"""
+import asyncio
+import mixcloud
+import mixcloud.ratelimit
+from mixcloud import API_ROOT, Artist, Cloudcast, Section, User
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+_SYNC_FETCH = ("Objects created by AsyncMixcloud cannot fetch data "
+               "synchronously, use the AsyncMixcloud methods")
+
+
+class AsyncMixcloud(object):
+    """
+    Counterpart of mixcloud.Mixcloud for asyncio applications.
+
+    It returns the same User, Cloudcast and Section objects. Since those
+    cannot fetch data by themselves without blocking, use the methods of
+    this client instead: cloudcast(), cloudcasts() and load().
+
+    All requests go through one aiohttp.ClientSession. limit caps the total
+    number of connections and limit_per_host the number of connections to a
+    single host (0 means no limit). A session can be passed instead, in
+    which case the client does not close it.
+
+    rate_limiter is an optional mixcloud.ratelimit.RateLimiter, which can
+    be shared with blocking clients.
+    """
+
+    def __init__(self, api_root=API_ROOT, access_token=None, limit=100,
+                 limit_per_host=0, keepalive_timeout=15, timeout=None,
+                 session=None, rate_limiter=None):
+        if session is None and aiohttp is None:
+            raise ImportError("AsyncMixcloud requires aiohttp")
+        self.api_root = api_root
+        if access_token is None:
+            access_token = mixcloud.netrc_access_token()
+        self.access_token = access_token
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.interner = mixcloud.Interner()
+        self._session = session
+        self._owns_session = session is None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    @property
+    def session(self):
+        """
+        The aiohttp.ClientSession used for all requests. It is created on
+        first use, since it has to be created from within the event loop.
+        """
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            timeout = aiohttp.ClientTimeout(total=self.timeout)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=timeout)
+        return self._session
+
+    async def close(self):
+        """
+        Close the session, unless it was provided by the caller.
+        """
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_json(self, endpoint, url, params=None):
+        raise TypeError(_SYNC_FETCH)
+
+    def _cloudcast_json(self, user, key, lazy_load=False):
+        raise TypeError(_SYNC_FETCH)
+
+    async def _fetch_json(self, url, params=None):
+        limiter = self.rate_limiter
+        retries = limiter.max_retries if limiter is not None else 0
+        for attempt in range(retries + 1):
+            if limiter is not None:
+                await _acquire(limiter)
+            async with self.session.get(url, params=params) as r:
+                if r.status != 429:
+                    if limiter is not None:
+                        limiter.succeeded()
+                    return await r.json(content_type=None)
+                retry_after = mixcloud.ratelimit.parse_retry_after(
+                    r.headers.get('Retry-After'))
+            if limiter is not None:
+                limiter.throttled(retry_after)
+        raise mixcloud.MixcloudRateLimitError(
+            'Rate limited on {}'.format(url), retry_after=retry_after)
+
+    async def artist(self, key):
+        url = '{root}/artist/{key}'.format(root=self.api_root, key=key)
+        data = await self._fetch_json(url)
+        return Artist.from_json(data)
+
+    async def user(self, key):
+        url = '{root}/{user}'.format(root=self.api_root, user=key)
+        data = await self._fetch_json(url)
+        return User.from_json(data, m=self)
+
+    async def me(self):
+        url = '{root}/me/'.format(root=self.api_root)
+        params = {'access_token': self.access_token}
+        data = await self._fetch_json(url, params)
+        return User.from_json(data, m=self)
+
+    async def cloudcast(self, user, key):
+        """
+        Async version of User.cloudcast. user is a User or a username.
+        """
+        url = '{root}/{user}/{cc}'.format(root=self.api_root,
+                                          user=_user_key(user),
+                                          cc=key)
+        data = await self._fetch_json(url)
+        return Cloudcast.from_json(data, m=self)
+
+    async def cloudcasts(self, user, limit=None, offset=None, lazy=False):
+        """
+        Async iterator over the cloudcasts of a user.
+
+        Without a limit, the pages advertised by the API are followed until
+        the end of the list. lazy is passed to Cloudcast.from_json.
+        """
+        url = '{root}/{user}/cloudcasts/'.format(root=self.api_root,
+                                                 user=_user_key(user))
+        params = {}
+        if limit is not None:
+            params['limit'] = limit
+        if offset is not None:
+            params['offset'] = offset
+        while url is not None:
+            data = await self._fetch_json(url, params=params)
+            for d in data['data']:
+                yield Cloudcast.from_json(d, m=self, lazy=lazy)
+            if limit is not None:
+                break
+            # The next URL already contains the query string.
+            url = data.get('paging', {}).get('next')
+            params = None
+
+    async def load(self, cloudcast):
+        """
+        Fetch the sections and description of a cloudcast that came from a
+        listing. This is the async version of Cloudcast.sections().
+        """
+        url = '{root}/{user}/{cc}'.format(root=self.api_root,
+                                          user=cloudcast.user.key,
+                                          cc=cloudcast.key)
+        d = await self._fetch_json(url)
+        cloudcast._sections = Section.list_from_json(d['sections'], m=self)
+        cloudcast._description = d['description']
+        return cloudcast
+
+    async def upload(self, cloudcast, mp3file, picturefile=None):
+        """
+        Upload a cloudcast. Its sections and description must be loaded.
+        Return the status code and decoded body of the response.
+        """
+        url = '{root}/upload/'.format(root=self.api_root)
+        form = aiohttp.FormData()
+        for k, v in mixcloud.upload_payload(cloudcast).items():
+            form.add_field(k, str(v))
+        form.add_field('mp3', mp3file, filename='mp3')
+        if picturefile is not None:
+            form.add_field('picture', picturefile, filename='picture')
+        params = {'access_token': self.access_token}
+        async with self.session.post(url, data=form, params=params) as r:
+            return r.status, await r.json(content_type=None)
+
+
+async def _acquire(limiter):
+    """
+    Like RateLimiter.acquire, but suspends the task instead of blocking.
+    """
+    delay = limiter.reserve()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+def _user_key(user):
+    if isinstance(user, User):
+        return user.key
+    return user
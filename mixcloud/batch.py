@@ -0,0 +1,150 @@
+"""
+Upload many shows described by YAML files at once.
+"""
+import collections
+import concurrent.futures
+import glob
+import os
+import time
+
+import mixcloud
+from mixcloud.ratelimit import TokenBucket
+
+AUDIO_EXTENSIONS = ('.mp3', '.m4a', '.ogg', '.flac', '.wav')
+PICTURE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+class BatchItem(collections.namedtuple('_BatchItem', 'yml audio picture')):
+    """
+    Paths to the files of a show. picture may be None.
+    """
+
+    def __new__(cls, yml, audio, picture=None):
+        return super(BatchItem, cls).__new__(cls, yml, audio, picture)
+
+
+class BatchItemReport(object):
+    """
+    Outcome of the upload of a BatchItem.
+
+    cloudcast is the parsed show, result the UploadResult (None if the
+    upload did not happen) and error the exception that prevented it, if
+    any. elapsed is the duration of the upload in seconds.
+    """
+
+    def __init__(self, item, cloudcast=None, result=None, error=None,
+                 elapsed=None):
+        self.item = item
+        self.cloudcast = cloudcast
+        self.result = result
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.error is None and self.result is not None \
+            and self.result.ok
+
+
+class BatchValidationError(Exception):
+    """
+    Some items of a batch are invalid. errors is a list of (item, exception)
+    pairs.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        lines = ['{}: {}'.format(item.yml, e) for item, e in errors]
+        super(BatchValidationError, self).__init__('\n'.join(lines))
+
+
+def _find_sibling(stem, extensions):
+    for ext in extensions:
+        for path in (stem + ext, stem + ext.upper()):
+            if os.path.exists(path):
+                return path
+    return None
+
+
+def scan_directory(path):
+    """
+    Find the shows in a directory: each show.yml (or show.yaml) goes with
+    the audio file and optional picture that have the same name. Shows
+    without an audio file are returned with audio set to None, so that
+    validation reports them.
+    """
+    ymls = glob.glob(os.path.join(path, '*.yml')) \
+        + glob.glob(os.path.join(path, '*.yaml'))
+    items = []
+    for yml in sorted(ymls):
+        stem = os.path.splitext(yml)[0]
+        items.append(BatchItem(yml,
+                               _find_sibling(stem, AUDIO_EXTENSIONS),
+                               _find_sibling(stem, PICTURE_EXTENSIONS)))
+    return items
+
+
+def validate(items, user):
+    """
+    Parse every item. Return the list of (item, cloudcast) pairs, or raise
+    BatchValidationError listing all the problems.
+    """
+    parsed = []
+    errors = []
+    for item in items:
+        try:
+            for path in (item.audio, item.picture):
+                if path is not None and not os.path.isfile(path):
+                    raise IOError('No such file: {}'.format(path))
+            if item.audio is None:
+                raise IOError('No audio file')
+            with open(item.yml) as f:
+                cloudcast = mixcloud.Cloudcast.from_yml(f, user)
+        except Exception as e:
+            errors.append((item, e))
+        else:
+            parsed.append((item, cloudcast))
+    if errors:
+        raise BatchValidationError(errors)
+    return parsed
+
+
+def upload_batch(m, items, max_workers=4, max_bandwidth=None, **kwargs):
+    """
+    Upload the shows described by items (BatchItem objects, or a directory
+    to scan) with the Mixcloud client m.
+
+    Every YAML file is parsed before the first upload starts. Then at most
+    max_workers uploads run at once, sharing max_bandwidth bytes per second
+    if it is given. Other arguments are passed to Mixcloud.upload.
+
+    Return a list of BatchItemReport, in the order of items.
+    """
+    if isinstance(items, str):
+        items = scan_directory(items)
+    user = m.me()
+    parsed = validate(items, user)
+    if max_bandwidth is not None:
+        kwargs['throttle'] = TokenBucket(max_bandwidth)
+
+    def upload(item, cloudcast):
+        report = BatchItemReport(item, cloudcast=cloudcast)
+        start = time.time()
+        try:
+            with open(item.audio, 'rb') as audio:
+                if item.picture is None:
+                    report.result = m.upload(cloudcast, audio, **kwargs)
+                else:
+                    with open(item.picture, 'rb') as picture:
+                        report.result = m.upload(cloudcast, audio,
+                                                 picturefile=picture,
+                                                 **kwargs)
+        except Exception as e:
+            report.error = e
+        report.elapsed = time.time() - start
+        return report
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+        futures = [pool.submit(upload, item, cloudcast)
+                   for item, cloudcast in parsed]
+        return [f.result() for f in futures]
@@ -0,0 +1,142 @@
+"""
+In-memory cache for API responses.
+"""
+import collections
+import threading
+import time
+
+
+class CacheEntry(object):
+
+    def __init__(self, body, expires, etag=None, last_modified=None):
+        self.body = body
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def fresh(self, now=None):
+        if now is None:
+            now = time.time()
+        return now < self.expires
+
+    def validators(self):
+        """
+        Headers that make a conditional request for this entry.
+        """
+        headers = {}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified is not None:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache(object):
+    """
+    LRU cache of response bodies, keyed by URL and query parameters.
+
+    Entries live for ttl seconds, or for the value given in ttls for their
+    endpoint template (for example '/{user}/cloudcasts/'). A TTL of 0
+    disables caching for an endpoint. When an expired entry carries an ETag
+    or Last-Modified header, the client revalidates it with a conditional
+    request instead of fetching it again.
+
+    The cache holds at most max_entries entries and max_bytes bytes of
+    bodies (None means no limit), evicting the least recently used ones.
+
+    Subclasses can store entries elsewhere by overriding lookup(), store()
+    and clear().
+    """
+
+    def __init__(self, ttl=300, ttls=None, max_entries=1024, max_bytes=None):
+        self.ttl = ttl
+        self.ttls = dict(ttls or {})
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.revalidations = 0
+        self.bytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(url, params=None):
+        if not params:
+            return url
+        return url + '?' + '&'.join('{}={}'.format(k, v)
+                                    for k, v in sorted(params.items()))
+
+    def ttl_for(self, endpoint):
+        return self.ttls.get(endpoint, self.ttl)
+
+    def lookup(self, key):
+        """
+        Return the entry for key, fresh or not, or None.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                # Reinsert as most recently used (no move_to_end on 2.7).
+                self._entries[key] = entry
+            if entry is not None and entry.fresh():
+                self.hits += 1
+            else:
+                self.misses += 1
+            return entry
+
+    def store(self, key, endpoint, body, headers):
+        """
+        Cache a response body, with the validators found in headers.
+        """
+        ttl = self.ttl_for(endpoint)
+        if not ttl:
+            return
+        entry = CacheEntry(body,
+                           time.time() + ttl,
+                           etag=headers.get('ETag'),
+                           last_modified=headers.get('Last-Modified'),
+                           )
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old.body)
+            self._entries[key] = entry
+            self.bytes += len(body)
+            self._evict()
+
+    def revalidated(self, key, endpoint, entry):
+        """
+        Mark entry as fresh again after the server answered 304.
+        """
+        entry.expires = time.time() + self.ttl_for(endpoint)
+        with self._lock:
+            self.revalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'revalidations': self.revalidations,
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                }
+
+    def _evict(self):
+        while self._entries and (
+                (self.max_entries is not None
+                 and len(self._entries) > self.max_entries)
+                or (self.max_bytes is not None
+                    and self.bytes > self.max_bytes)):
+            _, entry = self._entries.popitem(last=False)
+            self.bytes -= len(entry.body)
+            self.evictions += 1
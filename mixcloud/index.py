@@ -0,0 +1,144 @@
+"""
+Inverted index over the tracklists of cloudcasts.
+"""
+import bisect
+import json
+
+import mixcloud
+
+
+class TracklistIndex(object):
+    """
+    Finds which cloudcasts played an artist or a track.
+
+    Artists are indexed by key (or by slugified name when they have no key)
+    and tracks by slugified name. Queries are slugified the same way.
+    Results are sorted lists of postings, which are
+    ((user_key, cloudcast_key), start_time) pairs.
+
+    Cloudcasts can be added and removed at any time; adding a cloudcast
+    again replaces it. Its sections are fetched if necessary.
+    """
+
+    def __init__(self):
+        self._artists = {}
+        self._tracks = {}
+        self._artist_terms = []
+        self._track_terms = []
+        self._cloudcasts = {}
+
+    def __len__(self):
+        return len(self._cloudcasts)
+
+    def __contains__(self, cloudcast):
+        return _cloudcast_id(cloudcast) in self._cloudcasts
+
+    @staticmethod
+    def _entries(cloudcast):
+        entries = []
+        for sec in cloudcast.sections():
+            artist = sec.track.artist
+            artist_term = artist.key or mixcloud.slugify(artist.name)
+            track_term = mixcloud.slugify(sec.track.name)
+            entries.append((artist_term, track_term, sec.start_time))
+        return entries
+
+    def add(self, cloudcast):
+        self._add(_cloudcast_id(cloudcast), self._entries(cloudcast))
+
+    def _add(self, cc_id, entries):
+        self._remove(cc_id)
+        self._cloudcasts[cc_id] = entries
+        for artist_term, track_term, start in entries:
+            _post(self._artists, self._artist_terms, artist_term,
+                  (cc_id, start))
+            _post(self._tracks, self._track_terms, track_term,
+                  (cc_id, start))
+
+    def remove(self, cloudcast):
+        """
+        Remove a cloudcast, given as a Cloudcast or a (user_key,
+        cloudcast_key) pair.
+        """
+        if isinstance(cloudcast, mixcloud.Cloudcast):
+            cloudcast = _cloudcast_id(cloudcast)
+        self._remove(cloudcast)
+
+    def _remove(self, cc_id):
+        entries = self._cloudcasts.pop(cc_id, None)
+        if entries is None:
+            return
+        for artist_term, track_term, start in entries:
+            _unpost(self._artists, self._artist_terms, artist_term,
+                    (cc_id, start))
+            _unpost(self._tracks, self._track_terms, track_term,
+                    (cc_id, start))
+
+    def artist(self, name):
+        return sorted(self._artists.get(mixcloud.slugify(name), ()))
+
+    def track(self, name):
+        return sorted(self._tracks.get(mixcloud.slugify(name), ()))
+
+    def artist_prefix(self, prefix):
+        return _prefix(self._artists, self._artist_terms, prefix)
+
+    def track_prefix(self, prefix):
+        return _prefix(self._tracks, self._track_terms, prefix)
+
+    def artists(self):
+        """
+        The sorted list of indexed artist keys.
+        """
+        return list(self._artist_terms)
+
+    def save(self, f):
+        """
+        Write the index to a text file.
+        """
+        data = [[user, key, entries]
+                for (user, key), entries in self._cloudcasts.items()]
+        json.dump({'version': 1, 'cloudcasts': data}, f)
+
+    @staticmethod
+    def load(f):
+        index = TracklistIndex()
+        for user, key, entries in json.load(f)['cloudcasts']:
+            index._add((user, key), [tuple(e) for e in entries])
+        return index
+
+
+def _cloudcast_id(cloudcast):
+    user = cloudcast.user.key if cloudcast.user is not None else ''
+    return (user, cloudcast.key)
+
+
+def _post(postings, terms, term, posting):
+    if term not in postings:
+        postings[term] = set()
+        bisect.insort(terms, term)
+    postings[term].add(posting)
+
+
+def _unpost(postings, terms, term, posting):
+    found = postings.get(term)
+    if found is None:
+        return
+    found.discard(posting)
+    if not found:
+        del postings[term]
+        del terms[bisect.bisect_left(terms, term)]
+
+
+def _prefix(postings, terms, prefix):
+    """
+    Postings of all the terms starting with prefix.
+    """
+    prefix = mixcloud.slugify(prefix)
+    found = set()
+    for i in range(bisect.bisect_left(terms, prefix), len(terms)):
+        term = terms[i]
+        if not term.startswith(prefix):
+            break
+        found.update(postings[term])
+    return sorted(found)
@@ -0,0 +1,111 @@
+"""
+Incremental decoding of JSON list responses.
+"""
+import codecs
+import json
+
+_WHITESPACE = ' \t\n\r'
+_DELIMITERS = _WHITESPACE + ',:]}'
+# Consumed input is dropped from the buffer once it is this large.
+_TRIM = 64 * 1024
+
+
+class _Reader(object):
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def more(self):
+        """
+        Append the next chunk to the buffer. Return False at the end.
+        """
+        if self.eof:
+            return False
+        if self.pos > _TRIM:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        for chunk in self._chunks:
+            text = self._decoder.decode(chunk)
+            if text:
+                self.buf += text
+                return True
+        self.buf += self._decoder.decode(b'', final=True)
+        self.eof = True
+        return False
+
+    def peek(self):
+        """
+        The next non-whitespace character, which is not consumed.
+        """
+        while True:
+            while self.pos < len(self.buf) \
+                    and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.more():
+                raise ValueError('Unexpected end of JSON input')
+
+    def expect(self, chars):
+        c = self.peek()
+        if c not in chars:
+            raise ValueError('Expected {!r} at {!r}'.format(
+                chars, self.buf[self.pos:self.pos + 20]))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """
+        Decode the next value, reading as many chunks as needed.
+        """
+        self.peek()
+        while True:
+            try:
+                obj, end = self._json.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if self.more():
+                    continue
+                raise
+            # A number may continue in the next chunk: make sure that what
+            # follows the value is a delimiter.
+            if (end == len(self.buf) or self.buf[end] not in _DELIMITERS) \
+                    and self.more():
+                continue
+            self.pos = end
+            return obj
+
+
+def iter_items(chunks, key='data', members=None):
+    """
+    Decode a JSON object received as a sequence of byte chunks, and yield
+    the items of its key array as soon as each of them is complete. The
+    other members of the object are stored in the members dict, if given,
+    when they are read.
+    """
+    reader = _Reader(chunks)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        name = reader.value()
+        reader.expect(':')
+        if name == key and reader.peek() == '[':
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.pos += 1
+            else:
+                while True:
+                    yield reader.value()
+                    if reader.expect(',]') == ']':
+                        break
+        else:
+            value = reader.value()
+            if members is not None:
+                members[name] = value
+        if reader.expect(',}') == '}':
+            return
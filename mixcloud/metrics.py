@@ -0,0 +1,179 @@
+"""
+Request instrumentation.
+
+Mixcloud clients call their hooks around every HTTP request (see
+Mixcloud.add_hook) with a RequestInfo. Metrics is a hook that aggregates
+them per endpoint.
+"""
+import bisect
+import threading
+
+# Upper bounds of the latency histogram buckets, in seconds. The last
+# bucket has no upper bound.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+
+
+class RequestInfo(object):
+    """
+    Description of an HTTP request made by a client.
+
+    endpoint is the template of the URL, such as '/{user}/cloudcasts/'.
+    lazy_load is True when the request was made by a Cloudcast to load
+    missing fields, such as Cloudcast.sections() on a cloudcast from a
+    listing.
+    retries is the number of attempts made before this one.
+
+    status, elapsed (in seconds), bytes_received and error are only set in
+    the 'response' hooks. error is the exception raised by the request, if
+    any. bytes_received is None for streamed responses without a
+    Content-Length.
+    """
+
+    __slots__ = ('method', 'url', 'endpoint', 'lazy_load', 'retries',
+                 'bytes_sent', 'status', 'elapsed', 'bytes_received',
+                 'error')
+
+    def __init__(self, method, url, endpoint=None, lazy_load=False,
+                 retries=0, bytes_sent=0):
+        self.method = method
+        self.url = url
+        self.endpoint = endpoint
+        self.lazy_load = lazy_load
+        self.retries = retries
+        self.bytes_sent = bytes_sent
+        self.status = None
+        self.elapsed = None
+        self.bytes_received = None
+        self.error = None
+
+    def __repr__(self):
+        return '<RequestInfo {} {} {}>'.format(self.method,
+                                               self.endpoint or self.url,
+                                               self.status)
+
+
+class EndpointStats(object):
+    """
+    Counters and latency histogram of the requests to one endpoint.
+    histogram[i] is the number of requests that took at most
+    LATENCY_BUCKETS[i] seconds (and more than the previous bound).
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.lazy_loads = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.statuses = {}
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, info):
+        self.requests += 1
+        if info.error is not None or (info.status or 0) >= 400:
+            self.errors += 1
+        if info.lazy_load:
+            self.lazy_loads += 1
+        if info.retries:
+            self.retries += 1
+        self.bytes_sent += info.bytes_sent or 0
+        self.bytes_received += info.bytes_received or 0
+        self.statuses[info.status] = self.statuses.get(info.status, 0) + 1
+        elapsed = info.elapsed or 0.0
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+
+    @property
+    def mean_time(self):
+        if not self.requests:
+            return None
+        return self.total_time / self.requests
+
+    def percentile(self, p):
+        """
+        Upper bound of the bucket containing the pth percentile of the
+        latency (0 < p <= 100). It is max_time for the last bucket.
+        """
+        if not self.requests:
+            return None
+        rank = p / 100.0 * self.requests
+        seen = 0
+        for i, count in enumerate(self.histogram):
+            seen += count
+            if seen >= rank and count:
+                if i < len(LATENCY_BUCKETS):
+                    return min(LATENCY_BUCKETS[i], self.max_time)
+                return self.max_time
+        return self.max_time
+
+    def as_dict(self):
+        return {'requests': self.requests,
+                'errors': self.errors,
+                'lazy_loads': self.lazy_loads,
+                'retries': self.retries,
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+                'mean_time': self.mean_time,
+                'max_time': self.max_time,
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'p99': self.percentile(99),
+                'statuses': dict(self.statuses),
+                'histogram': list(self.histogram),
+                }
+
+
+class Metrics(object):
+    """
+    Aggregates the requests of one or more clients per endpoint. It can be
+    passed as the metrics argument of Mixcloud, or installed as a
+    'response' hook.
+
+    lazy_loads counts the requests made by cloudcasts to load missing
+    fields, per cloudcast. A cloudcast listed more than once there, or many
+    of them, point to an N+1 pattern: use Mixcloud.hydrate or
+    User.cloudcasts(eager=True) instead.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints = {}
+        self.lazy_loads = {}
+
+    def __call__(self, info):
+        endpoint = info.endpoint or info.url
+        with self._lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = EndpointStats()
+            stats.add(info)
+            if info.lazy_load:
+                self.lazy_loads[info.url] = \
+                    self.lazy_loads.get(info.url, 0) + 1
+
+    def __getitem__(self, endpoint):
+        return self.endpoints[endpoint]
+
+    @property
+    def requests(self):
+        return sum(s.requests for s in self.endpoints.values())
+
+    def snapshot(self):
+        """
+        A JSON serializable copy of the metrics.
+        """
+        with self._lock:
+            return {'endpoints': {e: s.as_dict()
+                                  for e, s in self.endpoints.items()},
+                    'lazy_loads': dict(self.lazy_loads),
+                    }
+
+    def reset(self):
+        with self._lock:
+            self.endpoints.clear()
+            self.lazy_loads.clear()
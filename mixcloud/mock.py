@@ -1,131 +1,472 @@
+"""
+Mock of the Mixcloud API, for tests.
+
+By default, MockServer registers its routes with httpretty, which must be
+enabled. With listen=True, it serves them instead from a real threaded
+HTTP server on a local port, which clients reach through api_root (and
+oauth_root). In both cases, latency, bandwidth limits and errors can be
+injected, and requests are counted per route.
+
+Users and cloudcasts are kept in an in-memory catalog, served by one route
+per URL pattern. Listings are precomputed, so that a page costs the same
+whatever the size of the catalog.
+"""
+import collections
 import datetime
+import hashlib
 import httpretty
 import json
 import mixcloud
+import re
+import threading
+import time
 try:
     import urlparse
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
 except ImportError:
     import urllib.parse as urlparse
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+
+class MockRequest(object):
+    """
+    A request received by the HTTP server. It has the attributes of the
+    httpretty requests that handlers use: method, path, headers, body
+    (bytes) and querystring (a dict of lists).
+
+    The body is only read when body is first accessed. iter_body() reads
+    it chunk by chunk instead.
+    """
+
+    def __init__(self, method, url, headers, stream):
+        self.method = method
+        self.url = url
+        parts = urlparse.urlsplit(url)
+        self.path = parts.path
+        self.querystring = urlparse.parse_qs(parts.query)
+        self.headers = headers
+        self.stream = stream
+        self._body = None
+
+    @property
+    def body(self):
+        if self._body is None:
+            self._body = self.stream.read()
+        return self._body
+
+    def iter_body(self, chunk_size=64 * 1024):
+        if self._body is not None:
+            yield self._body
+            return
+        while True:
+            chunk = self.stream.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+_Route = collections.namedtuple('_Route', 'name handler')
+
+# Start of the paths of user and cloudcast pages.
+_NOT_A_USER = r'/(?!(?:artist|me|oauth|upload)/)'
+# The fields of the cloudcasts in listings.
+_LIST_KEYS = ['tags', 'name', 'slug', 'user', 'created_time']
+
+
+class _Listing(object):
+    """
+    The cloudcasts of a user, newest first, as JSON listing entries.
+
+    Entries added with newest are kept in reverse order in _newest, the
+    others in _oldest, so that both kinds of additions are O(1).
+    _positions maps keys to their index in _oldest, or to -1 - their
+    index in _newest.
+    """
+
+    def __init__(self):
+        self._newest = []
+        self._oldest = []
+        self._positions = {}
+
+    def __len__(self):
+        return len(self._newest) + len(self._oldest)
+
+    def put(self, key, entry, newest=False):
+        """
+        Add an entry at the end (or at the start with newest), or replace
+        the entry with the same key.
+        """
+        i = self._positions.get(key)
+        if i is not None:
+            if i >= 0:
+                self._oldest[i] = entry
+            else:
+                self._newest[-1 - i] = entry
+        elif newest:
+            self._positions[key] = -1 - len(self._newest)
+            self._newest.append(entry)
+        else:
+            self._positions[key] = len(self._oldest)
+            self._oldest.append(entry)
+
+    def entries(self, start=0, end=None):
+        """
+        The entries from start to end (excluded), newest first.
+        """
+        n = len(self._newest)
+        if end is None:
+            end = len(self)
+        head = self._newest[max(0, n - end):max(0, n - start)][::-1]
+        return head + self._oldest[max(0, start - n):max(0, end - n)]
+
+
+class _Fault(object):
+
+    def __init__(self, status, path, method, times, retry_after):
+        self.status = status
+        self.path = re.compile(path or '')
+        self.method = method
+        self.times = times
+        self.retry_after = retry_after
 
 
 class MockServer:
+    """
+    Routes are kept in a table, by method and URL. A route has a name, the
+    template of its URL (such as '/{user}/cloudcasts/'), which is used to
+    count requests, and a handler with the signature of httpretty
+    callbacks: handler(request, uri, headers) -> (status, headers, body).
+    Routes with a regular expression as URL are tried after the others.
+    """
 
-    def __init__(self, api_root=None, oauth_root=None):
+    def __init__(self, api_root=None, oauth_root=None, listen=False,
+                 host='127.0.0.1', port=0):
+        self._routes = {}
+        self._patterns = []
+        self._users = {}
+        self._cloudcasts = {}
+        self._listings = {}
+        self._lock = threading.Lock()
+        self._latency = []
+        self._bandwidth = []
+        self._faults = []
+        self.counts = collections.Counter()
+        self.uploads = []
+        self._httpd = None
+        self.address = None
+        if listen:
+            self._httpd = _HTTPServer((host, port), _Handler)
+            self._httpd.mock = self
+            self.address = 'http://{}:{}'.format(
+                *self._httpd.server_address[:2])
+            thread = threading.Thread(target=self._httpd.serve_forever,
+                                      args=(0.05,))
+            thread.daemon = True
+            thread.start()
         if api_root is None:
-            api_root = mixcloud.API_ROOT
+            api_root = self.address or mixcloud.API_ROOT
         self.api_root = api_root
         if oauth_root is None:
-            oauth_root = mixcloud.OAUTH_ROOT
+            if self.address is not None:
+                oauth_root = self.address + '/oauth'
+            else:
+                oauth_root = mixcloud.OAUTH_ROOT
         self.oauth_root = oauth_root
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Stop the HTTP server, if there is one.
+        """
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def _route(self, method, url, handler, name):
+        pattern = not isinstance(url, str)
+        with self._lock:
+            if pattern:
+                self._patterns.append((method, url, _Route(name, handler)))
+            else:
+                self._routes[(method, url)] = _Route(name, handler)
+        if self.address is None:
+            assert httpretty.is_enabled()
+
+            def callback(request, uri, headers):
+                target = uri.split('?', 1)[0] if pattern else url
+                status, headers, body, bandwidth = \
+                    self._dispatch(method, target, request, uri, headers)
+                if bandwidth:
+                    time.sleep(len(body) / float(bandwidth))
+                return (status, headers, body)
+            # URIs registered directly with httpretty take precedence.
+            httpretty.register_uri(method, url, body=callback,
+                                   priority=-1 if pattern else 0)
+
+    def _find(self, method, url):
+        route = self._routes.get((method, url))
+        if route is None:
+            for m, pattern, r in self._patterns:
+                if m == method and pattern.match(url):
+                    return r
+        return route
+
+    def _static(self, method, url, name, body, status=200, headers=None):
+        def handler(request, uri, response_headers):
+            response_headers.update(headers or {})
+            return (status, response_headers, body)
+        self._route(method, url, handler, name)
+
+    def _dispatch(self, method, url, request, uri, headers):
+        """
+        Answer a request to the route (method, url). Return the status,
+        headers and body of the response, and the bandwidth to send it at.
+        """
+        route = self._find(method, url)
+        path = urlparse.urlsplit(url).path
+        with self._lock:
+            self.counts[(method, route.name if route else None)] += 1
+        delay = _lookup(self._latency, path)
+        if delay:
+            time.sleep(delay)
+        fault = self._fault(method, path)
+        if fault is not None:
+            if fault.retry_after is not None:
+                headers['Retry-After'] = str(fault.retry_after)
+            return (fault.status, headers, '{}', None)
+        if route is None:
+            return (404, headers, '{}', None)
+        status, headers, body = route.handler(request, uri, headers)
+        return (status, headers, body, _lookup(self._bandwidth, path))
+
+    def _fault(self, method, path):
+        with self._lock:
+            for fault in self._faults:
+                if fault.method not in (None, method) \
+                        or not fault.path.search(path):
+                    continue
+                if fault.times is not None:
+                    fault.times -= 1
+                    if fault.times <= 0:
+                        self._faults.remove(fault)
+                return fault
+        return None
+
+    def set_latency(self, seconds, path=None):
+        """
+        Delay the responses to the requests whose path matches the regular
+        expression path (all of them by default).
+        """
+        self._latency.insert(0, (re.compile(path or ''), seconds))
+
+    def set_bandwidth(self, bytes_per_second, path=None):
+        """
+        Send the responses to the requests whose path matches path at most
+        at bytes_per_second.
+        """
+        self._bandwidth.insert(0, (re.compile(path or ''), bytes_per_second))
+
+    def inject_error(self, status, path=None, method=None, times=1,
+                     retry_after=None):
+        """
+        Answer the next times requests whose path matches path (forever if
+        times is None) with status, such as 429 or 503, and a Retry-After
+        header if retry_after is given.
+        """
+        with self._lock:
+            self._faults.append(_Fault(status, path, method, times,
+                                       retry_after))
+
+    def request_count(self, name=None, method=None):
+        """
+        Number of requests received for the route name (all routes by
+        default) with method (all methods by default).
+        """
+        with self._lock:
+            return sum(n for (m, r), n in self.counts.items()
+                       if method in (None, m) and name in (None, r))
+
     def i_am(self, user):
-        assert httpretty.is_enabled()
         target_url = '{root}/{key}'.format(root=self.api_root, key=user.key)
         self.register_user(user)
-        httpretty.register_uri(httpretty.GET,
-                               '{root}/me/'.format(root=self.api_root),
-                               status=302,
-                               location=target_url)
+        self._static(httpretty.GET, '{root}/me/'.format(root=self.api_root),
+                     '/me/', '', status=302,
+                     headers={'Location': target_url})
 
     def register_artist(self, artist):
-        assert httpretty.is_enabled()
         url = '{root}/artist/{key}'.format(root=self.api_root, key=artist.key)
         data = {'slug': artist.key,
                 'name': artist.name,
                 }
-        httpretty.register_uri(httpretty.GET, url, body=json.dumps(data))
+        self._static(httpretty.GET, url, '/artist/{key}', json.dumps(data))
+
+    def _catalog_routes(self):
+        if self._patterns:
+            return
+        # httpretty matches URLs regardless of the method, so the paths of
+        # the other routes must be left out.
+        root = re.escape(self.api_root) + _NOT_A_USER
+        self._route(httpretty.GET,
+                    re.compile(root + r'[^/]+/cloudcasts/$'),
+                    self._cloudcast_list, '/{user}/cloudcasts/')
+        self._route(httpretty.GET, re.compile(root + r'[^/]+/[^/]+/?$'),
+                    self._cloudcast, '/{user}/{cloudcast}')
+        self._route(httpretty.GET, re.compile(root + r'[^/]+/?$'),
+                    self._user, '/{user}')
+
+    def _catalog_path(self, uri):
+        path = uri.split('?', 1)[0][len(self.api_root):]
+        return path.strip('/').split('/')
+
+    def _user(self, request, uri, headers):
+        key, = self._catalog_path(uri)
+        body = self._users.get(key)
+        if body is None:
+            return (404, headers, '{}')
+        return (200, headers, body)
+
+    def _cloudcast(self, request, uri, headers):
+        user, key = self._catalog_path(uri)
+        body = self._cloudcasts.get((user, key))
+        if body is None:
+            return (404, headers, '{}')
+        return (200, headers, body)
+
+    def _cloudcast_list(self, request, uri, headers):
+        user = self._catalog_path(uri)[0]
+        if user not in self._users:
+            return (404, headers, '{}')
+        listing = self._listings.get(user, _Listing())
+        query_params = urlparse.parse_qs(urlparse.urlsplit(uri).query)
+        limit = None
+        offset = 0
+        if 'limit' in query_params:
+            limit = int(query_params['limit'][-1])
+        if 'offset' in query_params:
+            offset = int(query_params['offset'][-1])
+        end = len(listing) if limit is None else offset + limit
+        paging = {}
+        if limit is not None:
+            url = '{root}/{user}/cloudcasts/'.format(root=self.api_root,
+                                                     user=user)
+            page_url = '{url}?limit={limit}&offset={offset}'
+            if end < len(listing):
+                paging['next'] = page_url.format(url=url, limit=limit,
+                                                 offset=end)
+            if offset > 0:
+                paging['previous'] = page_url.format(
+                    url=url, limit=limit, offset=max(0, offset - limit))
+        # Listing entries are already encoded.
+        body = '{{"data": [{}], "paging": {}}}'.format(
+            ', '.join(listing.entries(offset, end)), json.dumps(paging))
+        return (200, headers, body)
 
     def register_user(self, user):
-        assert httpretty.is_enabled()
-        url = '{root}/{key}'.format(root=self.api_root, key=user.key)
+        self._catalog_routes()
         data = {'username': user.key,
                 'name': user.name,
                 }
-        httpretty.register_uri(httpretty.GET, url, body=json.dumps(data))
+        with self._lock:
+            self._users[user.key] = json.dumps(data)
 
-    def _register_cloudcast_only(self, user, cloudcast):
-        assert httpretty.is_enabled()
-        self.register_user(user)
-        url = '{root}/{user}/{key}'.format(root=self.api_root,
-                                           user=user.key,
-                                           key=cloudcast.key)
-        cc_data = {'slug': cloudcast.key,
-                   'name': cloudcast.name,
-                   'sections':
-                   [{'start_time': s.start_time,
-                     'track':
-                     {'name': s.track.name,
-                      'artist':
-                      {'slug': s.track.artist.key,
-                       'name': s.track.artist.name,
-                       },
-                      },
-                     }
-                    for s in cloudcast.sections()],
-                   'tags': [{'name': t}
-                            for t in cloudcast.tags],
-                   'description': cloudcast.description(),
-                   'user': {'username': user.key,
-                            'name': user.name,
-                            },
-                   'created_time': cloudcast.created_time.isoformat(),
-                   'pictures': {
-                       'large': 'http://httpbin.org/status/418',
-                       }
-                   }
-        httpretty.register_uri(httpretty.GET, url, body=json.dumps(cc_data))
+    def _cloudcast_data(self, user, cloudcast):
+        cloudcast.sections()
+        cloudcast.description()
+        cc_data = cloudcast.to_json()
+        cc_data['user'] = {'username': user.key,
+                           'name': user.name,
+                           }
+        cc_data['pictures'] = {
+            'large': 'http://httpbin.org/status/418',
+        }
         return cc_data
 
-    def _register_cloudcast_list(self, user, cloudcasts):
-        assert httpretty.is_enabled()
-        url = '{root}/{user}/cloudcasts/'.format(root=self.api_root,
-                                                 user=user.key)
-
-        def make_cc_data(cc):
-            keys_ok = ['tags', 'name', 'slug', 'user', 'created_time']
-            return {k: cc[k] for k in keys_ok}
-
-        def cloudcast_list(method, uri, headers):
-            query_string = urlparse.urlparse(uri).query
-            query_params = urlparse.parse_qs(query_string)
-            limit = None
-            offset = None
-            if 'limit' in query_params:
-                limit = int(query_params['limit'][-1])
-            if 'offset' in query_params:
-                offset = int(query_params['offset'][-1])
-
-            data = [make_cc_data(cc) for cc in cloudcasts]
-            if offset is not None:
-                data = data[offset:]
-            if limit is not None:
-                data = data[:limit]
-            body = json.dumps({'data': data})
-            return (200, headers, body)
-
-        httpretty.register_uri(httpretty.GET, url, body=cloudcast_list)
+    def _add(self, cc_data, listing=None, newest=False):
+        """
+        Add a cloudcast, given as the JSON returned by the API, to the
+        catalog and to listing (the listing of its user by default).
+        """
+        user = cc_data['user']
+        key = user['username']
+        body = json.dumps(cc_data)
+        entry = json.dumps({k: cc_data[k] for k in _LIST_KEYS})
+        with self._lock:
+            if key not in self._users:
+                self._users[key] = json.dumps({'username': key,
+                                               'name': user['name'],
+                                               })
+            self._cloudcasts[(key, cc_data['slug'])] = body
+            if listing is None:
+                listing = self._listings.get(key)
+                if listing is None:
+                    listing = self._listings[key] = _Listing()
+            listing.put(cc_data['slug'], entry, newest=newest)
 
     def register_cloudcast(self, user, cloudcast):
-        self.register_cloudcasts(user, [cloudcast])
+        """
+        Add cloudcast as the newest cloudcast of user.
+        """
+        self.register_user(user)
+        self._add(self._cloudcast_data(user, cloudcast), newest=True)
 
     def register_cloudcasts(self, user, cloudcasts):
-        assert httpretty.is_enabled()
-        cc_data_list = []
+        """
+        Register the cloudcasts of user, newest first. They replace the
+        previous listing of the user.
+        """
+        self.register_user(user)
+        listing = _Listing()
         for cloudcast in cloudcasts:
-            cc_data = self._register_cloudcast_only(user, cloudcast)
-            cc_data_list.append(cc_data)
-        self._register_cloudcast_list(user, cc_data_list)
+            self._add(self._cloudcast_data(user, cloudcast), listing)
+        with self._lock:
+            self._listings[user.key] = listing
+
+    def register_catalog(self, cloudcasts):
+        """
+        Add many cloudcasts at once, from an iterable of dicts as returned
+        by the API for /{user}/{cloudcast}, including user. Users are
+        registered as needed, and cloudcasts are appended to their
+        listings in order.
+        """
+        self._catalog_routes()
+        for cc_data in cloudcasts:
+            self._add(cc_data)
 
     def handle_upload(self, upload_callback):
-        assert httpretty.is_enabled()
-        httpretty.register_uri(httpretty.POST,
-                               '{root}/upload/'.format(root=self.api_root),
-                               body=upload_callback
-                               )
+        self._route(httpretty.POST,
+                    '{root}/upload/'.format(root=self.api_root),
+                    upload_callback, '/upload/')
 
-    def mock_upload(self, user):
+    def mock_upload(self, user, hash=None):
+        """
+        Accept uploads, and register the cloudcasts they describe. The
+        files are not kept: the FileField describing them (with their
+        digest, if hash is the name of a hashlib algorithm) can be found
+        in uploads, along with the other fields.
+        """
         def mock_upload(request, uri, headers):
-            data = parse_multipart(request.body)
+            if isinstance(request, MockRequest):
+                body = request.iter_body()
+            else:
+                body = request.body
+            try:
+                data = parse_multipart(body,
+                                       boundary=_boundary(request.headers),
+                                       hash=hash)
+            except ValueError as e:
+                error = {'error': {'type': 'ValidationError',
+                                   'message': str(e)}}
+                return (400, headers, json.dumps(error))
+            with self._lock:
+                self.uploads.append(data)
             name = data['name']
             key = mixcloud.slugify(name)
             sections, tags = parse_headers(data)
@@ -138,43 +479,302 @@ class MockServer:
         self.handle_upload(mock_upload)
 
     def oauth_exchange(self):
-        assert httpretty.is_enabled()
         target_url = '{root}/{endpoint}'.format(root=self.oauth_root,
                                                 endpoint='access_token')
         data = {"access_token": "my_access_token"}
-        httpretty.register_uri(httpretty.GET,
-                               target_url,
-                               body=json.dumps(data))
+        self._static(httpretty.GET, target_url, '/oauth/access_token',
+                     json.dumps(data))
 
     def oauth_exchange_fail(self):
-        assert httpretty.is_enabled()
         target_url = '{root}/{endpoint}'.format(root=self.oauth_root,
                                                 endpoint='access_token')
-        httpretty.register_uri(httpretty.GET, target_url, status=500)
-
-
-def parse_multipart(d):
-    lines = d.split(b'\n')
-    k = None
-    v = None
-    res = {}
-    for l in lines:
-        l = l.strip()
-        if l.startswith(b'Content-Disposition'):
-            parts = l.split(b'"')
-            k = parts[1]
-        elif l.startswith(b'--'):
+        self._static(httpretty.GET, target_url, '/oauth/access_token', '',
+                     status=500)
+
+
+def _lookup(rules, path):
+    for pattern, value in rules:
+        if pattern.search(path):
+            return value
+    return None
+
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send the headers and the body together, without waiting for ACKs.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def _serve(self):
+        mock = self.server.mock
+        url = mock.address + self.path
+        request = MockRequest(self.command, url, self.headers,
+                              _BodyReader(self.rfile, self.headers))
+        route_url = url.split('?', 1)[0]
+        status, headers, body, bandwidth = mock._dispatch(
+            self.command, route_url, request, url,
+            {'Content-Type': 'application/json'})
+        # Skip what the handler did not read, to reuse the connection.
+        while request.stream.read(64 * 1024):
             pass
-        elif l == '':
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        if not bandwidth:
+            self.wfile.write(body)
+            return
+        # Send about 20 chunks per second.
+        chunk_size = max(1, int(bandwidth / 20))
+        for i in range(0, len(body), chunk_size):
+            chunk = body[i:i + chunk_size]
+            self.wfile.write(chunk)
+            self.wfile.flush()
+            time.sleep(len(chunk) / float(bandwidth))
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _serve
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _BodyReader(object):
+    """
+    File object reading the body of a request from the connection, given
+    its headers: either Content-Length bytes or a chunked body.
+    """
+
+    def __init__(self, rfile, headers):
+        self._rfile = rfile
+        self._chunked = \
+            headers.get('Transfer-Encoding', '').lower() == 'chunked'
+        # Bytes left in the body, or in the current chunk.
+        self._left = 0 if self._chunked \
+            else int(headers.get('Content-Length') or 0)
+        self._done = False
+
+    def _next_chunk(self):
+        if self._done:
+            return
+        line = self._rfile.readline()
+        if self._left == 0 and line.strip() == b'':
+            # End of the previous chunk.
+            line = self._rfile.readline()
+        self._left = int(line.split(b';')[0], 16)
+        if self._left == 0:
+            # Skip the trailers.
+            while self._rfile.readline() not in (b'\r\n', b'\n', b''):
+                pass
+            self._done = True
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0:
+            if self._left == 0:
+                if not self._chunked:
+                    break
+                self._next_chunk()
+                if self._done:
+                    break
+            n = self._left if size < 0 else min(size, self._left)
+            chunk = self._rfile.read(n)
+            if not chunk:
+                break
+            self._left -= len(chunk)
+            if size > 0:
+                size -= len(chunk)
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+
+class FileField(collections.namedtuple('FileField',
+                                       'filename content_type size digest')):
+    """
+    A file part of a multipart body. Its content is not kept: digest is the
+    hex digest of the bytes, or None if they were not hashed.
+    """
+
+    __slots__ = ()
+
+
+_DISPOSITION_PARAM = re.compile(r'(\w+)="([^"]*)"')
+
+
+class MultipartParser(object):
+    """
+    Incremental multipart/form-data parser. Data is passed to feed() in
+    chunks of any size. Field values are kept, but file parts are only
+    counted, and hashed if hash is given (the name of a hashlib algorithm).
+
+    boundary is read from the first line if it is not given.
+    """
+
+    def __init__(self, boundary=None, hash=None):
+        self.fields = {}
+        self._hash = hash
+        self._buf = bytearray()
+        self._delimiter = None
+        if boundary is not None:
+            if not isinstance(boundary, bytes):
+                boundary = boundary.encode('ascii')
+            self._delimiter = b'--' + boundary
+        self._state = self._preamble
+        self._part = None
+
+    def feed(self, data):
+        self._buf += data
+        while self._state():
             pass
+
+    def close(self):
+        """
+        Return the fields, which map names to strings or FileField.
+        """
+        if self._state != self._end:
+            raise ValueError('Truncated multipart body')
+        return self.fields
+
+    # Each state consumes what it can from the buffer, and returns whether
+    # the next state should run right away.
+
+    def _preamble(self):
+        buf = self._buf
+        if self._delimiter is None:
+            i = buf.find(b'\r\n')
+            if i < 0:
+                return False
+            if not buf.startswith(b'--'):
+                raise ValueError('Multipart body without a boundary')
+            self._delimiter = bytes(buf[:i])
+            del buf[:i]
+        else:
+            i = buf.find(self._delimiter)
+            if i < 0:
+                del buf[:max(0, len(buf) - len(self._delimiter) + 1)]
+                return False
+            del buf[:i + len(self._delimiter)]
+        self._state = self._after_delimiter
+        return True
+
+    def _after_delimiter(self):
+        buf = self._buf
+        if len(buf) < 2:
+            return False
+        if buf.startswith(b'--'):
+            self._state = self._end
+        elif buf.startswith(b'\r\n'):
+            del buf[:2]
+            self._state = self._headers
         else:
-            v = l
-            if k is not None and v is not None:
-                if type(k) == bytes:
-                    k = k.decode('utf-8')
-                v = v.decode('utf-8')
-                res[k] = v
-    return res
+            raise ValueError('Malformed multipart boundary')
+        return True
+
+    def _headers(self):
+        buf = self._buf
+        i = buf.find(b'\r\n\r\n')
+        if i < 0:
+            if len(buf) > 64 * 1024:
+                raise ValueError('Multipart headers too long')
+            return False
+        headers = {}
+        for line in bytes(buf[:i]).decode('utf-8').split('\r\n'):
+            k, _, v = line.partition(':')
+            headers[k.strip().lower()] = v.strip()
+        del buf[:i + 4]
+        params = dict(_DISPOSITION_PARAM.findall(
+            headers.get('content-disposition', '')))
+        filename = params.get('filename')
+        if filename is None:
+            sink = []
+        elif self._hash is not None:
+            sink = hashlib.new(self._hash)
+        else:
+            sink = None
+        self._part = [params.get('name'), filename,
+                      headers.get('content-type'), sink, 0]
+        self._state = self._body
+        return True
+
+    def _body(self):
+        buf = self._buf
+        separator = b'\r\n' + self._delimiter
+        i = buf.find(separator)
+        if i < 0:
+            # The end of the buffer may be the start of the separator.
+            self._emit(len(buf) - len(separator) + 1)
+            return False
+        self._emit(i)
+        del buf[:len(separator)]
+        name, filename, content_type, sink, size = self._part
+        if filename is None:
+            self.fields[name] = b''.join(sink).decode('utf-8')
+        else:
+            digest = sink.hexdigest() if sink is not None else None
+            self.fields[name] = FileField(filename, content_type, size,
+                                          digest)
+        self._part = None
+        self._state = self._after_delimiter
+        return True
+
+    def _emit(self, n):
+        """
+        Pass the first n bytes of the buffer to the current part.
+        """
+        if n <= 0:
+            return
+        part = self._part
+        sink = part[3]
+        part[4] += n
+        if isinstance(sink, list):
+            sink.append(bytes(self._buf[:n]))
+        elif sink is not None:
+            data = memoryview(self._buf)[:n]
+            sink.update(data)
+            # Release the view, or _buf could not be resized.
+            del data
+        del self._buf[:n]
+
+    def _end(self):
+        # Ignore the epilogue.
+        del self._buf[:]
+        return False
+
+
+def parse_multipart(d, boundary=None, hash=None, chunk_size=64 * 1024):
+    """
+    Parse a multipart/form-data body, given as bytes, a file object or an
+    iterable of chunks. See MultipartParser.
+    """
+    parser = MultipartParser(boundary, hash=hash)
+    if isinstance(d, (bytes, bytearray)):
+        view = memoryview(d)
+        for i in range(0, len(d), chunk_size):
+            parser.feed(view[i:i + chunk_size])
+    elif hasattr(d, 'read'):
+        while True:
+            chunk = d.read(chunk_size)
+            if not chunk:
+                break
+            parser.feed(chunk)
+    else:
+        for chunk in d:
+            parser.feed(chunk)
+    return parser.close()
+
+
+def _boundary(headers):
+    match = re.search(r'boundary="?([^";]+)"?',
+                      headers.get('Content-Type') or '')
+    return match.group(1) if match else None
 
 
 def listify(d):
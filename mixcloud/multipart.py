@@ -0,0 +1,139 @@
+"""
+Streaming multipart/form-data encoder for uploads.
+"""
+import io
+import os
+import time
+import uuid
+
+
+class MultipartBody(object):
+    """
+    A multipart/form-data request body that is read from the files as it
+    is sent, so that memory usage does not depend on their size.
+
+    fields maps names to values and files maps names to file objects opened
+    in binary mode. Files are read from their current position, chunk_size
+    bytes at a time. Text files are accepted too but are encoded in memory.
+
+    It behaves as a file object of known length and can be passed as the
+    data of a request, along with content_type as Content-Type header.
+
+    progress, if given, is called as progress(sent, total, elapsed) each
+    time a chunk is read, elapsed being the time in seconds since the first
+    read.
+
+    throttle is an optional mixcloud.ratelimit.TokenBucket counting bytes,
+    which can be shared between bodies to cap their total bandwidth.
+    """
+
+    def __init__(self, fields, files, boundary=None, chunk_size=64 * 1024,
+                 progress=None, throttle=None):
+        if boundary is None:
+            boundary = uuid.uuid4().hex
+        self.boundary = boundary
+        self.content_type = 'multipart/form-data; boundary=' + boundary
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.throttle = throttle
+        self._parts = []
+        for name, value in fields.items():
+            header = self._part_header(name)
+            self._parts.append(header + _to_bytes(value) + b'\r\n')
+        for name, f in files.items():
+            filename = os.path.basename(getattr(f, 'name', None) or name)
+            header = self._part_header(name, filename)
+            self._parts.append(header)
+            self._parts.append(_FilePart(f))
+            self._parts.append(b'\r\n')
+        self._parts.append('--{}--\r\n'.format(boundary).encode('ascii'))
+        self.len = sum(len(p) for p in self._parts)
+        self.reset()
+
+    def __len__(self):
+        return self.len
+
+    def _part_header(self, name, filename=None):
+        disposition = 'form-data; name="{}"'.format(name)
+        lines = ['--' + self.boundary]
+        if filename is None:
+            lines.append('Content-Disposition: ' + disposition)
+        else:
+            disposition += '; filename="{}"'.format(filename)
+            lines.append('Content-Disposition: ' + disposition)
+            lines.append('Content-Type: application/octet-stream')
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8')
+
+    def reset(self):
+        """
+        Rewind the body, including the files, to send it again.
+        """
+        for part in self._parts:
+            if isinstance(part, _FilePart):
+                part.reset()
+        self._index = 0
+        self._offset = 0
+        self.sent = 0
+        self._started = None
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.len
+        size = min(size, self.chunk_size)
+        chunks = []
+        while size > 0 and self._index < len(self._parts):
+            part = self._parts[self._index]
+            if isinstance(part, _FilePart):
+                chunk = part.read(size)
+            else:
+                chunk = part[self._offset:self._offset + size]
+                self._offset += len(chunk)
+            if not chunk:
+                self._index += 1
+                self._offset = 0
+                continue
+            chunks.append(chunk)
+            size -= len(chunk)
+        data = b''.join(chunks)
+        if data and self.throttle is not None:
+            self.throttle.consume(len(data))
+        if data and self.progress is not None:
+            if self._started is None:
+                self._started = time.time()
+            self.sent += len(data)
+            self.progress(self.sent, self.len, time.time() - self._started)
+        return data
+
+
+class _FilePart(object):
+
+    def __init__(self, f):
+        if isinstance(f.read(0), bytes):
+            self._f = f
+        else:
+            self._f = io.BytesIO(f.read().encode('utf-8'))
+        self._start = self._f.tell()
+        try:
+            end = os.fstat(self._f.fileno()).st_size
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            self._f.seek(0, os.SEEK_END)
+            end = self._f.tell()
+            self._f.seek(self._start)
+        self._len = end - self._start
+
+    def __len__(self):
+        return self._len
+
+    def reset(self):
+        self._f.seek(self._start)
+
+    def read(self, size):
+        return self._f.read(size)
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    if not isinstance(value, type(u'')):
+        value = str(value)
+    return value.encode('utf-8')
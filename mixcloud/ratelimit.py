@@ -0,0 +1,156 @@
+"""
+Rate limiting primitives.
+"""
+import email.utils
+import threading
+import time
+
+# Clock for rates and pauses. time.monotonic is missing before Python 3.3.
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket that refills at rate tokens per second, up to
+    capacity tokens (rate by default).
+
+    Tokens are reserved even when not available yet: the bucket goes into
+    debt and the caller is told how long to wait. This keeps callers in
+    order and allows requests larger than the capacity.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        if capacity is None:
+            capacity = rate
+        self.capacity = float(capacity)
+        self._tokens = self.capacity
+        self._last = monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = max(0.0, now - self._last)
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._last = now
+
+    def reserve(self, n=1):
+        """
+        Take n tokens and return how long to wait before using them.
+        """
+        with self._lock:
+            self._refill(monotonic())
+            self._tokens -= n
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def consume(self, n=1):
+        """
+        Take n tokens, sleeping until they are available.
+        """
+        delay = self.reserve(n)
+        if delay > 0:
+            time.sleep(delay)
+
+    @property
+    def wait_time(self):
+        """
+        How long a request for one token would wait now.
+        """
+        with self._lock:
+            self._refill(monotonic())
+            return max(0.0, (1 - self._tokens) / self.rate)
+
+
+class RateLimiter(object):
+    """
+    Request rate limiter shared by everything a client sends.
+
+    Requests are spaced to at most rate per second, with bursts of up to
+    burst requests. When the server answers 429, throttled() is called:
+    every request is then held back for the Retry-After delay and the rate
+    is halved (down to min_rate). Each successful request raises it again
+    by recovery, up to max_rate.
+
+    acquire() blocks the calling thread. The limiter can also be shared
+    with mixcloud.aio.AsyncMixcloud, which suspends the calling task
+    instead. A 429 is retried up to max_retries times.
+    """
+
+    def __init__(self, rate=10.0, burst=None, min_rate=0.1, max_rate=None,
+                 recovery=0.1, max_retries=5):
+        self._bucket = TokenBucket(rate, burst)
+        self.min_rate = min_rate
+        if max_rate is None:
+            max_rate = rate
+        self.max_rate = max_rate
+        self.recovery = recovery
+        self.max_retries = max_retries
+        self.throttled_count = 0
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        """
+        The current rate, in requests per second.
+        """
+        return self._bucket.rate
+
+    @property
+    def wait_time(self):
+        """
+        How long a request made now would wait, in seconds.
+        """
+        pause = self._paused_until - monotonic()
+        return max(pause, self._bucket.wait_time)
+
+    def reserve(self):
+        """
+        Reserve a request and return how long to wait before sending it.
+        """
+        delay = self._bucket.reserve()
+        pause = self._paused_until - monotonic()
+        return max(delay, pause, 0.0)
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def throttled(self, retry_after=None):
+        """
+        Record a 429 response, with the delay from its Retry-After header.
+        """
+        if retry_after is None:
+            retry_after = 1.0 / self.rate
+        with self._lock:
+            self.throttled_count += 1
+            self._paused_until = max(self._paused_until,
+                                     monotonic() + retry_after)
+            self._bucket.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self):
+        """
+        Record a successful response.
+        """
+        if self.rate < self.max_rate:
+            with self._lock:
+                self._bucket.rate = min(self.max_rate,
+                                        self.rate + self.recovery)
+
+
+def parse_retry_after(value):
+    """
+    Decode a Retry-After header into a number of seconds, or None.
+    """
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(parsed) - time.time())
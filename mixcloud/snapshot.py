@@ -0,0 +1,236 @@
+"""
+Export and import catalogs of cloudcasts.
+
+Two formats are supported:
+
+* JSON lines: one cloudcast per line, encoded as the API does (see
+  Cloudcast.to_json).
+* A compact binary format, made of fixed-size integer records pointing
+  into a table of distinct strings. It is read through mmap, and strings
+  are only decoded the first time they are used.
+
+Reading and writing are both done with generators, so that catalogs do not
+have to fit in memory.
+"""
+import json
+import mmap
+import struct
+import sys
+from array import array
+
+import mixcloud
+
+MAGIC = b'MXCS'
+FOOTER_MAGIC = b'MXCE'
+VERSION = 1
+NONE = 0xFFFFFFFF
+
+_header = struct.Struct('<4sI')
+# key, name, description, user key, user name, created time, pictures,
+# number of tags, number of sections (NONE if unknown).
+_record = struct.Struct('<9I')
+# start time, track name, artist key, artist name.
+_section = struct.Struct('<4I')
+# start of the string table, number of cloudcasts, number of strings.
+_footer = struct.Struct('<QQQ4s')
+
+
+def iter_dump_jsonl(cloudcasts):
+    """
+    Yield the lines of a JSON lines export of cloudcasts.
+    """
+    for cc in cloudcasts:
+        yield json.dumps(cc.to_json(), sort_keys=True) + '\n'
+
+
+def dump_jsonl(cloudcasts, f):
+    for line in iter_dump_jsonl(cloudcasts):
+        f.write(line)
+
+
+def iter_load_jsonl(lines, m=None, lazy=False):
+    """
+    Yield the cloudcasts of a JSON lines export. m and lazy are passed to
+    Cloudcast.from_json.
+    """
+    for line in lines:
+        if line.strip():
+            yield mixcloud.Cloudcast.from_json(json.loads(line), m=m,
+                                               lazy=lazy)
+
+
+def iter_dump_binary(cloudcasts):
+    """
+    Yield the chunks of a binary export of cloudcasts.
+    """
+    strings = {}
+    # The strings in table order: dicts are only ordered from Python 3.7.
+    table = []
+
+    def ref(s):
+        if s is None:
+            return NONE
+        i = strings.get(s)
+        if i is None:
+            i = strings[s] = len(table)
+            table.append(s)
+        return i
+
+    yield _header.pack(MAGIC, VERSION)
+    offset = _header.size
+    count = 0
+    for cc in cloudcasts:
+        user = cc.user
+        pictures = cc.pictures
+        if pictures is not None:
+            pictures = json.dumps(pictures, sort_keys=True)
+        sections = cc._sections
+        if sections is not None:
+            sections = cc.sections()
+        chunks = [_record.pack(ref(cc.key),
+                               ref(cc.name),
+                               ref(cc._description),
+                               ref(user.key if user is not None else None),
+                               ref(user.name if user is not None else None),
+                               ref(mixcloud.format_datetime(cc.created_time)),
+                               ref(pictures),
+                               len(cc.tags),
+                               NONE if sections is None else len(sections),
+                               )]
+        chunks.append(struct.pack('<%dI' % len(cc.tags),
+                                  *[ref(t) for t in cc.tags]))
+        for sec in sections or ():
+            artist = sec.track.artist
+            chunks.append(_section.pack(sec.start_time,
+                                        ref(sec.track.name),
+                                        ref(artist.key),
+                                        ref(artist.name)))
+        chunk = b''.join(chunks)
+        offset += len(chunk)
+        count += 1
+        yield chunk
+
+    table_start = offset
+    encoded = [s.encode('utf-8') for s in table]
+    offsets = array('I', [0])
+    for b in encoded:
+        offsets.append(offsets[-1] + len(b))
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+    yield _tobytes(offsets)
+    for b in encoded:
+        yield b
+    yield _footer.pack(table_start, count, len(encoded), FOOTER_MAGIC)
+
+
+def dump_binary(cloudcasts, f):
+    """
+    Write a binary export of cloudcasts to f, opened in binary mode.
+    """
+    for chunk in iter_dump_binary(cloudcasts):
+        f.write(chunk)
+
+
+def _tobytes(a):
+    # array.tobytes is called tostring before Python 3.2.
+    if hasattr(a, 'tobytes'):
+        return a.tobytes()
+    return a.tostring()
+
+
+class _StringTable(object):
+    """
+    Strings of a binary export, decoded on first use.
+
+    The offsets are read in place where memoryview.cast is available
+    (Python 3.3) and the byte order allows it, and copied otherwise.
+    """
+
+    def __init__(self, buf, start, count):
+        size = 4 * (count + 1)
+        if sys.byteorder == 'little' and hasattr(memoryview, 'cast'):
+            self._offsets = memoryview(buf)[start:start + size].cast('I')
+        else:
+            self._offsets = array('I', bytes(buf[start:start + size]))
+            if sys.byteorder != 'little':
+                self._offsets.byteswap()
+        self._buf = buf
+        self._blob = start + size
+        self._decoded = [None] * count
+
+    def __getitem__(self, i):
+        if i == NONE:
+            return None
+        s = self._decoded[i]
+        if s is None:
+            start = self._blob + self._offsets[i]
+            end = self._blob + self._offsets[i + 1]
+            s = self._decoded[i] = self._buf[start:end].decode('utf-8')
+        return s
+
+    def release(self):
+        # The mmap cannot be closed while a view on it is alive.
+        if isinstance(self._offsets, memoryview):
+            self._offsets.release()
+
+
+def iter_load_binary(path, m=None):
+    """
+    Yield the cloudcasts of the binary export at path. Artists, users and
+    tags are shared between cloudcasts (through the interner of m if it is
+    given).
+    """
+    interner = m.interner if m is not None else mixcloud.Interner()
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        magic, version = _header.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a cloudcast snapshot: {}'.format(path))
+        table_start, count, n_strings, end_magic = \
+            _footer.unpack_from(buf, len(buf) - _footer.size)
+        if end_magic != FOOTER_MAGIC:
+            raise ValueError('Truncated snapshot: {}'.format(path))
+        strings = _StringTable(buf, table_start, n_strings)
+        try:
+            pos = _header.size
+            for _ in range(count):
+                cc, pos = _read_cloudcast(buf, pos, strings, interner, m)
+                yield cc
+        finally:
+            strings.release()
+    finally:
+        buf.close()
+
+
+def _read_cloudcast(buf, pos, strings, interner, m):
+    (key, name, desc, user_key, user_name, created, pictures,
+     n_tags, n_sections) = _record.unpack_from(buf, pos)
+    pos += _record.size
+    tags = [interner.tag(strings[t])
+            for t in struct.unpack_from('<%dI' % n_tags, buf, pos)]
+    pos += 4 * n_tags
+    sections = None
+    if n_sections != NONE:
+        end = pos + _section.size * n_sections
+        sections = [
+            mixcloud.Section(start, mixcloud.Track(
+                strings[track], interner.artist(strings[artist_key],
+                                                strings[artist_name])))
+            for start, track, artist_key, artist_name
+            in (_section.unpack_from(buf, p)
+                for p in range(pos, end, _section.size))]
+        pos = end
+    user = None
+    if user_key != NONE:
+        user = interner.user(strings[user_key], strings[user_name], m=m)
+    created_time = strings[created]
+    if created_time is not None:
+        created_time = mixcloud.parse_datetime(created_time)
+    pictures = strings[pictures]
+    if pictures is not None:
+        pictures = json.loads(pictures)
+    cc = mixcloud.Cloudcast(strings[key], strings[name], sections, tags,
+                            strings[desc], user, created_time,
+                            pictures=pictures, m=m)
+    return cc, pos
@@ -0,0 +1,110 @@
+"""
+Persistent SQLite store for API metadata.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    key TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    fetched REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cloudcasts (
+    user TEXT NOT NULL,
+    key TEXT NOT NULL,
+    data TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    PRIMARY KEY (user, key)
+);
+"""
+
+
+class MetadataStore(object):
+    """
+    Keeps the users and cloudcasts (with their tracklists) fetched by a
+    client in a SQLite database, so that they survive restarts.
+
+    Records are stored as the JSON returned by the API, along with the time
+    they were fetched. Only records younger than max_age seconds are
+    returned.
+
+    The database is in WAL mode and each thread of each process opens its
+    own connection, so several workers on the same host can share a file.
+    """
+
+    def __init__(self, path, max_age=24 * 3600, timeout=30.0):
+        self.path = path
+        self.max_age = max_age
+        self.timeout = timeout
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        # Connections must not be shared with a forked child.
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        """
+        Close the connection of the calling thread.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _get(self, query, args, max_age):
+        if max_age is None:
+            max_age = self.max_age
+        conn = self._connection()
+        row = conn.execute(query, args + (time.time() - max_age,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def get_user(self, key, max_age=None):
+        return self._get('SELECT data FROM users '
+                         'WHERE key = ? AND fetched >= ?',
+                         (key,), max_age)
+
+    def put_user(self, data):
+        with self._connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO users VALUES (?, ?, ?)',
+                         (data['username'], json.dumps(data), time.time()))
+
+    def get_cloudcast(self, user, key, max_age=None):
+        return self._get('SELECT data FROM cloudcasts '
+                         'WHERE user = ? AND key = ? AND fetched >= ?',
+                         (user, key), max_age)
+
+    def put_cloudcast(self, data):
+        """
+        Store a full cloudcast, as returned by /{user}/{cloudcast}.
+        """
+        with self._connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO cloudcasts '
+                         'VALUES (?, ?, ?, ?)',
+                         (data['user']['username'], data['slug'],
+                          json.dumps(data), time.time()))
+
+    def purge(self, max_age=None):
+        """
+        Delete the records older than max_age.
+        """
+        if max_age is None:
+            max_age = self.max_age
+        limit = time.time() - max_age
+        with self._connection() as conn:
+            conn.execute('DELETE FROM users WHERE fetched < ?', (limit,))
+            conn.execute('DELETE FROM cloudcasts WHERE fetched < ?', (limit,))
@@ -19,7 +19,11 @@ setuptools.setup(name='mixcloud',
                      'requests',
                      'unidecode',
                      'pyyaml',
+                     'futures; python_version < "3"',
                  ],
+                 extras_require={
+                     'async': ['aiohttp'],
+                 },
                  description='Bindings for the mixcloud.com API',
                  long_description=readme + '\n\n' + history,
                  classifiers=[
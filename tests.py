@@ -1,10 +1,32 @@
 import csv
 import datetime
+import email
+import email.utils
+import functools
+import hashlib
 import dateutil.tz
 import httpretty
 import mixcloud
 import io
+import json
+import os
+import requests
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from mixcloud.batch import BatchValidationError, scan_directory, upload_batch
+from mixcloud.cache import ResponseCache
+from mixcloud.index import TracklistIndex
+from mixcloud.jsonstream import iter_items
+from mixcloud.metrics import Metrics
+from mixcloud.multipart import MultipartBody
+from mixcloud.ratelimit import RateLimiter, TokenBucket
+from mixcloud.snapshot import (dump_binary, iter_dump_jsonl,
+                               iter_load_binary, iter_load_jsonl)
+from mixcloud.store import MetadataStore
 from mixcloud.mock import MockServer, parse_headers, parse_multipart
 
 try:
@@ -17,6 +39,21 @@ except ImportError:
     from urlparse import urlsplit
     import mock
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# The asyncio tests use syntax that older Pythons cannot even parse.
+if sys.version_info >= (3, 7) and aiohttp is not None:
+    from aiotests import TestAsyncMixcloud  # noqa: F401
+else:
+    @unittest.skip('requires Python 3.7 and aiohttp')
+    class TestAsyncMixcloud(unittest.TestCase):
+
+        def testAsyncMixcloud(self):
+            pass
+
 
 def parse_tracklist(s):
     s = s.split('\n')[1:-1]
@@ -76,6 +113,29 @@ lambiance = mixcloud.Cloudcast(
 )
 
 
+def make_cloudcasts(n):
+    """
+    n cloudcasts by spartacus, newest first.
+    """
+    return [mixcloud.Cloudcast('show-%d' % i, 'Show %d' % i,
+                               partytime.sections(), partytime.tags,
+                               'Show number %d' % i, spartacus,
+                               partytime.created_time
+                               + datetime.timedelta(days=n - i))
+            for i in range(n)]
+
+
+class RecordingFile(io.BytesIO):
+
+    def __init__(self, data):
+        io.BytesIO.__init__(self, data)
+        self.reads = []
+
+    def read(self, size=-1):
+        self.reads.append(size)
+        return io.BytesIO.read(self, size)
+
+
 class TestMixcloud(unittest.TestCase):
 
     @classmethod
@@ -169,6 +229,103 @@ class TestMixcloud(unittest.TestCase):
         self.assertEqual(cc.tags, ['Funky house', 'Funk', 'Soul'])
         self.assertEqual(cc.description(), 'Bla bla')
 
+    def testUploadStreaming(self):
+        bodies = []
+
+        def upload_callback(request, uri, headers):
+            bodies.append(request.body)
+            return (200, headers, '{}')
+
+        self.mc.handle_upload(upload_callback)
+        mp3 = b'\x00\n\r\xff' * 50000
+        mp3file = RecordingFile(mp3)
+        calls = []
+
+        def progress(sent, total, elapsed):
+            calls.append((sent, total))
+
+        r = self.m.upload(partytime, mp3file, progress=progress,
+                          chunk_size=4096)
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(all(0 <= n <= 4096 for n in mp3file.reads[1:]))
+        self.assertGreater(len(calls), 40)
+        sent, total = calls[-1]
+        self.assertEqual(sent, total)
+        self.assertEqual(total, len(bodies[0]))
+        self.assertIn(mp3, bodies[0])
+
+    @mock.patch('time.sleep')
+    def testUploadRetry(self, sleep):
+        self.mc.i_am(spartacus)
+        statuses = [503, 502, 200]
+        bodies = []
+
+        def upload_callback(request, uri, headers):
+            bodies.append(request.body)
+            return (statuses.pop(0), headers, '{}')
+
+        self.mc.handle_upload(upload_callback)
+        httpretty.register_uri(httpretty.GET,
+                               mixcloud.API_ROOT + '/spartacus/party-time',
+                               status=404, body='{}')
+        mp3file = io.BytesIO(b'\x00' * 30)
+        uploads = []
+        self.m.add_hook('response', lambda info: uploads.append(info)
+                        if info.endpoint == '/upload/' else None)
+        r = self.m.upload(partytime, mp3file, backoff=2)
+        self.assertTrue(r.ok)
+        self.assertEqual([(i.status, i.retries) for i in uploads],
+                         [(503, 0), (502, 1), (200, 2)])
+        self.assertEqual(uploads[0].bytes_sent, len(bodies[0]))
+        self.assertEqual(r.key, 'party-time')
+        self.assertEqual(r.attempts, 3)
+        self.assertEqual(len(set(bodies)), 1)
+        delays = [call[0][0] for call in sleep.call_args_list]
+        self.assertTrue(0 <= delays[0] <= 2)
+        self.assertTrue(0 <= delays[1] <= 4)
+
+        statuses[:] = [500] * 3
+        r = self.m.upload(partytime, mp3file, retries=2)
+        self.assertFalse(r.ok)
+        self.assertEqual((r.attempts, r.status_code), (3, 500))
+
+    @mock.patch('time.sleep')
+    def testUploadRetryExisting(self, sleep):
+        self.mc.i_am(spartacus)
+
+        def upload_callback(request, uri, headers):
+            # The upload goes through but the response is lost.
+            self.mc.register_cloudcast(spartacus, partytime)
+            return (504, headers, '{}')
+
+        self.mc.handle_upload(upload_callback)
+        r = self.m.upload(partytime, io.BytesIO(b'\x00' * 30))
+        self.assertTrue(r.ok)
+        self.assertTrue(r.existing)
+        self.assertEqual(r.attempts, 1)
+
+    @mock.patch('time.sleep')
+    def testUploadRetryCheckFails(self, sleep):
+        statuses = [503, 200]
+        self.mc.handle_upload(
+            lambda request, uri, headers: (statuses.pop(0), headers, '{}'))
+        checks = [requests.ConnectionError('down'), False]
+        with mock.patch.object(self.m, '_uploaded',
+                               side_effect=checks) as uploaded:
+            r = self.m.upload(partytime, io.BytesIO(b'\x00' * 30))
+        self.assertTrue(r.ok)
+        self.assertEqual(r.attempts, 2)
+        self.assertEqual(uploaded.call_count, 2)
+
+        statuses[:] = [503]
+        with mock.patch.object(self.m, '_uploaded',
+                               side_effect=requests.Timeout('slow')):
+            r = self.m.upload(partytime, io.BytesIO(b'\x00' * 30),
+                              retries=2)
+        self.assertFalse(r.ok)
+        self.assertEqual(r.attempts, 1)
+        self.assertIsInstance(r.error, requests.Timeout)
+
     def testCloudcastsSection(self):
         self.mc.register_cloudcast(spartacus, partytime)
         u = self.m.user('spartacus')
@@ -196,6 +353,223 @@ class TestMixcloud(unittest.TestCase):
         self.assertEqual(len(ccs), 1)
         self.assertEqual(ccs[0].key, 'lambiance')
 
+    def testIterCloudcasts(self):
+        shows = make_cloudcasts(7)
+        self.mc.register_cloudcasts(spartacus, shows)
+        u = self.m.user('spartacus')
+        for prefetch in [0, 1, 3]:
+            ccs = list(u.iter_cloudcasts(page_size=2, prefetch=prefetch))
+            self.assertEqual([cc.key for cc in ccs],
+                             [cc.key for cc in shows])
+
+    def testIterCloudcastsStream(self):
+        shows = make_cloudcasts(5)
+        self.mc.register_cloudcasts(spartacus, shows)
+        u = self.m.user('spartacus')
+        ccs = list(u.iter_cloudcasts(page_size=2, stream=True))
+        self.assertEqual([cc.key for cc in ccs], [cc.key for cc in shows])
+        self.assertEqual(ccs[4].created_time, shows[4].created_time)
+        ccs = u.iter_cloudcasts(page_size=2, stream=True, max_items=3,
+                                created_before=shows[0].created_time)
+        self.assertEqual([cc.key for cc in ccs], ['show-1', 'show-2',
+                                                  'show-3'])
+
+    def testIterCloudcastsStop(self):
+        shows = make_cloudcasts(7)
+        self.mc.register_cloudcasts(spartacus, shows)
+        u = self.m.user('spartacus')
+        n_requests = len(httpretty.latest_requests())
+        ccs = list(u.iter_cloudcasts(page_size=2, prefetch=0, max_items=3))
+        self.assertEqual([cc.key for cc in ccs], ['show-0', 'show-1',
+                                                  'show-2'])
+        self.assertEqual(len(httpretty.latest_requests()) - n_requests, 2)
+        ccs = u.iter_cloudcasts(page_size=2,
+                                created_before=shows[1].created_time,
+                                created_after=shows[5].created_time)
+        self.assertEqual([cc.key for cc in ccs], ['show-2', 'show-3',
+                                                  'show-4'])
+
+    def testIterCloudcastsMaxItemsBefore(self):
+        shows = make_cloudcasts(7)
+        self.mc.register_cloudcasts(spartacus, shows)
+        u = self.m.user('spartacus')
+        for prefetch in (0, 1):
+            ccs = u.iter_cloudcasts(page_size=2, prefetch=prefetch,
+                                    max_items=3,
+                                    created_before=shows[1].created_time)
+            self.assertEqual([cc.key for cc in ccs],
+                             ['show-2', 'show-3', 'show-4'])
+
+    def testSync(self):
+        shows = make_cloudcasts(5)
+        self.mc.register_cloudcasts(spartacus, shows[2:])
+        u = self.m.user('spartacus')
+        r = u.sync(page_size=2)
+        self.assertEqual([cc.key for cc in r.cloudcasts],
+                         ['show-2', 'show-3', 'show-4'])
+        self.assertEqual(r.watermark, shows[2].created_time)
+
+        n_requests = len(httpretty.latest_requests())
+        r = u.sync(since=r.watermark, page_size=2)
+        self.assertEqual((r.cloudcasts, r.watermark),
+                         ([], shows[2].created_time))
+        self.assertEqual(len(httpretty.latest_requests()), n_requests + 1)
+
+        self.mc.register_cloudcasts(spartacus, shows)
+        r = u.sync(since=r.watermark, page_size=2)
+        self.assertEqual([cc.key for cc in r.cloudcasts],
+                         ['show-0', 'show-1'])
+        self.assertEqual(r.watermark, shows[0].created_time)
+
+    def testCatalog(self):
+        def catalog(n):
+            for i in range(n):
+                yield {'slug': 'show-%d' % i,
+                       'name': 'Show %d' % i,
+                       'tags': [],
+                       'user': {'username': 'user-%d' % (i % 2),
+                                'name': 'User %d' % (i % 2)},
+                       'created_time': '2015-01-01T00:00:00Z',
+                       'description': '',
+                       'sections': [],
+                       }
+        self.mc.register_catalog(catalog(20000))
+        u = self.m.user('user-1')
+        self.assertEqual(u.name, 'User 1')
+        self.assertEqual([cc.key for cc in u.cloudcasts(limit=3, offset=6)],
+                         ['show-13', 'show-15', 'show-17'])
+        url = mixcloud.API_ROOT + '/user-1/cloudcasts/'
+        paging = self.m.session.get(url, params={'limit': 3, 'offset': 6})\
+            .json()['paging']
+        self.assertEqual(paging, {
+            'next': url + '?limit=3&offset=9',
+            'previous': url + '?limit=3&offset=3',
+        })
+        self.assertEqual(len(list(u.iter_cloudcasts(page_size=1000))),
+                         10000)
+        self.assertEqual(self.mc.request_count('/{user}/cloudcasts/'), 12)
+        self.assertEqual(u.cloudcast('show-19999').name, 'Show 19999')
+
+        self.mc.register_catalog(catalog(4))
+        self.assertEqual([cc.key for cc in u.cloudcasts(limit=3)],
+                         ['show-1', 'show-3', 'show-5'])
+        self.assertEqual(len(list(u.iter_cloudcasts(page_size=1000))),
+                         10000)
+        shows = make_cloudcasts(2)
+        for cloudcast in shows + shows:
+            self.mc.register_cloudcast(spartacus, cloudcast)
+        u = self.m.user('spartacus')
+        self.assertEqual([cc.key for cc in u.cloudcasts()],
+                         ['show-1', 'show-0'])
+
+    def testSyncCache(self):
+        shows = make_cloudcasts(4)
+        self.mc.register_cloudcasts(spartacus, shows[2:])
+        m = mixcloud.Mixcloud(cache=ResponseCache())
+        u = m.user('spartacus')
+        r = u.sync(page_size=2)
+        self.assertEqual(len(r.cloudcasts), 2)
+        self.mc.register_cloudcasts(spartacus, shows)
+        r = u.sync(since=r.watermark, page_size=2)
+        self.assertEqual([cc.key for cc in r.cloudcasts],
+                         ['show-0', 'show-1'])
+        self.assertEqual(len(list(u.iter_cloudcasts(page_size=2))), 4)
+
+    def testMetrics(self):
+        self.mc.register_cloudcasts(spartacus, make_cloudcasts(3))
+        metrics = Metrics()
+        m = mixcloud.Mixcloud(metrics=metrics)
+        seen = []
+        m.add_hook('request', lambda info: seen.append(info.endpoint))
+        ccs = m.user('spartacus').cloudcasts()
+        for cc in ccs:
+            cc.sections()
+        m.hydrate(ccs)
+        self.assertEqual(seen, ['/{user}', '/{user}/cloudcasts/'] +
+                         ['/{user}/{cloudcast}'] * 3)
+        self.assertEqual(metrics.requests, 5)
+        stats = metrics['/{user}/{cloudcast}']
+        self.assertEqual(stats.requests, 3)
+        self.assertEqual(stats.lazy_loads, 3)
+        self.assertEqual(stats.statuses, {200: 3})
+        self.assertGreater(stats.bytes_received, 0)
+        self.assertEqual(sum(stats.histogram), 3)
+        self.assertEqual(metrics['/{user}/cloudcasts/'].lazy_loads, 0)
+        self.assertEqual(len(metrics.lazy_loads), 3)
+        snapshot = json.loads(json.dumps(metrics.snapshot()))
+        self.assertEqual(snapshot['endpoints']['/{user}']['requests'], 1)
+
+    def testCache(self):
+        self.mc.register_cloudcast(spartacus, partytime)
+        cache = ResponseCache(ttls={'/{user}': 0})
+        m = mixcloud.Mixcloud(cache=cache)
+        n_requests = len(httpretty.latest_requests())
+        for _ in range(3):
+            u = m.user('spartacus')
+            cc = u.cloudcast('party-time')
+        self.assertEqual(cc.sections()[1].track.name, 'Refresher')
+        # Users are not cached, the cloudcast is fetched once.
+        self.assertEqual(len(httpretty.latest_requests()) - n_requests, 4)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        self.assertEqual(len(cache), 1)
+
+    def testCacheEviction(self):
+        self.mc.register_cloudcasts(spartacus, make_cloudcasts(3))
+        cache = ResponseCache(max_entries=2)
+        m = mixcloud.Mixcloud(cache=cache)
+        u = m.user('spartacus')
+        for key in ['show-0', 'show-1', 'show-2', 'show-2']:
+            u.cloudcast(key)
+        self.assertEqual(cache.stats()['evictions'], 2)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(len(cache), 2)
+        cache = ResponseCache(max_bytes=1)
+        mixcloud.Mixcloud(cache=cache).user('spartacus')
+        self.assertEqual((len(cache), cache.bytes), (0, 0))
+
+    def testCacheRevalidation(self):
+        url = mixcloud.API_ROOT + '/spartacus'
+
+        def user(request, uri, headers):
+            if request.headers.get('If-None-Match') == '"v1"':
+                return (304, headers, '')
+            headers['ETag'] = '"v1"'
+            return (200, headers, '{"username": "spartacus", '
+                                  '"name": "Spartacus"}')
+
+        httpretty.register_uri(httpretty.GET, url, body=user)
+        cache = ResponseCache(ttl=1e-9)
+        m = mixcloud.Mixcloud(cache=cache)
+        self.assertEqual(m.user('spartacus').name, 'Spartacus')
+        self.assertEqual(m.user('spartacus').name, 'Spartacus')
+        self.assertEqual(cache.revalidations, 1)
+        self.assertEqual(cache.misses, 2)
+
+    def testStore(self):
+        self.mc.register_cloudcast(spartacus, partytime)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'store.db')
+        store = MetadataStore(path)
+        m = mixcloud.Mixcloud(store=store)
+        m.user('spartacus').cloudcasts()[0].sections()
+        store.close()
+
+        # A new worker starts from what the previous one fetched.
+        store = MetadataStore(path)
+        m = mixcloud.Mixcloud(store=store)
+        n_requests = len(httpretty.latest_requests())
+        u = m.user('spartacus')
+        cc = u.cloudcast('party-time')
+        self.assertEqual(cc.sections()[1].track.name, 'Refresher')
+        self.assertEqual(cc.description(), 'Bla bla')
+        self.assertEqual(len(httpretty.latest_requests()), n_requests)
+
+        self.assertIsNone(store.get_user('spartacus', max_age=-1))
+        store.purge(max_age=-1)
+        self.assertIsNone(store.get_cloudcast('spartacus', 'party-time'))
+        store.close()
+
     def testYaml(self):
         self.mc.i_am(spartacus)
         self.mc.mock_upload(self.m.me())
@@ -216,6 +590,136 @@ class TestMixcloud(unittest.TestCase):
         self.assertEqual(cc.tags, tags)
         self.assertIn("In this mix we jump", cc.description())
 
+    @mock.patch('time.sleep')
+    def testRateLimit(self, sleep):
+        self.mc.register_user(spartacus)
+        url = mixcloud.API_ROOT + '/spartacus'
+        httpretty.register_uri(
+            httpretty.GET, url,
+            responses=[
+                httpretty.Response(body='{}', status=429,
+                                   adding_headers={'Retry-After': '7'}),
+                httpretty.Response(body='{"username": "spartacus", '
+                                        '"name": "Spartacus"}'),
+            ])
+        limiter = RateLimiter(rate=8)
+        m = mixcloud.Mixcloud(rate_limiter=limiter)
+        self.assertEqual(m.user('spartacus').name, 'Spartacus')
+        self.assertEqual(limiter.throttled_count, 1)
+        self.assertAlmostEqual(limiter.rate, 4.1)
+        self.assertAlmostEqual(sleep.call_args[0][0], 7, places=1)
+        self.assertGreater(limiter.wait_time, 6)
+
+    def testRateLimitError(self):
+        httpretty.register_uri(httpretty.GET,
+                               mixcloud.API_ROOT + '/spartacus',
+                               body='{}', status=429,
+                               adding_headers={'Retry-After': '30'})
+        with self.assertRaises(mixcloud.MixcloudRateLimitError) as cm:
+            self.m.user('spartacus')
+        self.assertEqual(cm.exception.retry_after, 30)
+
+    def testInterning(self):
+        shows = make_cloudcasts(2)
+        self.mc.register_cloudcasts(spartacus, shows)
+        u = self.m.user('spartacus')
+        a, b = [u.cloudcast(cc.key) for cc in shows]
+        self.assertIs(a.user, b.user)
+        self.assertIs(a.sections()[0].track.artist,
+                      b.sections()[0].track.artist)
+        self.assertIs(a.tags[0], b.tags[0])
+        with self.assertRaises(AttributeError):
+            a.extra = None
+
+    def testLazy(self):
+        self.mc.register_cloudcasts(spartacus, [partytime, lambiance])
+        u = self.m.user('spartacus')
+        eager = u.cloudcasts()
+        lazy = u.cloudcasts(lazy=True)
+        self.assertIs(lazy[0]._tags, mixcloud._UNSET)
+        for a, b in zip(eager, lazy):
+            self.assertEqual(b.created_time, a.created_time)
+            self.assertIs(b._tags, mixcloud._UNSET)
+            self.assertEqual(b.tags, a.tags)
+            self.assertIs(b.user, a.user)
+            self.assertEqual(b.pictures, a.pictures)
+            self.assertEqual(b.sections(), a.sections())
+            self.assertEqual(b.description(), a.description())
+        n_requests = len(httpretty.latest_requests())
+        data = self.m._cloudcast_json('spartacus', 'lambiance')
+        cc = mixcloud.Cloudcast.from_json(data, m=self.m, lazy=True)
+        self.assertEqual(cc.sections()[3].track.artist.name, 'Aphex Twin')
+        self.assertEqual(cc.description(), 'Bla bla bla')
+        self.assertEqual(len(httpretty.latest_requests()), n_requests + 1)
+
+    def testSlugify(self):
+        self.assertEqual(mixcloud.slugify(u'Pino d\'Angio'), 'pino-d-angio')
+        self.assertEqual(mixcloud.slugify(u'Caf\xe9 Tacvba'), 'cafe-tacvba')
+        hits = mixcloud.slugify.cache_info().hits
+        slugs = mixcloud.slugify_many([u'Daft Punk', u'Caf\xe9 Tacvba',
+                                       u'Daft Punk'])
+        self.assertEqual(slugs, ['daft-punk', 'cafe-tacvba', 'daft-punk'])
+        self.assertEqual(mixcloud.slugify.cache_info().hits, hits + 1)
+
+    def testMemoizeFallback(self):
+        # Python 2 has no functools.lru_cache.
+        with mock.patch.object(mixcloud, 'functools', mock.Mock(
+                spec=['update_wrapper'],
+                update_wrapper=functools.update_wrapper)):
+            slugify = mixcloud._memoize(2)(mixcloud.slugify.__wrapped__)
+        self.assertEqual([slugify(n) for n in [u'A b', u'A b', u'\xc9 c',
+                                               u'D']],
+                         ['a-b', 'a-b', 'e-c', 'd'])
+        self.assertEqual(slugify.cache_info(), (1, 3, 2, 1))
+        slugify.cache_clear()
+        self.assertEqual(slugify.cache_info(), (0, 0, 2, 0))
+
+    def testYamlStream(self):
+        with open('example.yml') as f:
+            example = f.read()
+        stream = io.StringIO(example + u'---\n'
+                             + example.replace('Sample & Funky', 'Again'))
+        ccs = mixcloud.Cloudcast.iter_from_yml(stream, spartacus)
+        self.assertEqual([(cc.key, cc.sections()[1].start_time)
+                          for cc in ccs],
+                         [('sample-funky', 85), ('again', 85)])
+
+    def testYamlInvalid(self):
+        with io.open('example.yml', encoding='utf-8') as f:
+            example = f.read()
+        for old, new in [('start: 1:25', 'start: 1:75'),
+                         ('start: 1:25', 'start: 11:30'),
+                         ('start: 1:25', 'start: -3'),
+                         ('title:', 'name:')]:
+            f = io.StringIO(example.replace(old, new))
+            with self.assertRaises(mixcloud.MixcloudYamlError):
+                mixcloud.Cloudcast.from_yml(f, spartacus)
+
+    def testSectionAt(self):
+        self.assertIsNone(lambiance.section_at(5))
+        self.assertEqual(lambiance.section_at(10).track.name,
+                         'As Serious As Your Life')
+        self.assertEqual(lambiance.section_at(45).track.name, 'Vordhosbn')
+        self.assertEqual(partytime.section_at(10 ** 6).track.name,
+                         'All in my head')
+        secs = mixcloud.sections_at([(partytime, 500), (lambiance, 0),
+                                     (partytime, 716)])
+        self.assertEqual([s and s.track.name for s in secs],
+                         ['Refresher', None, 'My time (feat. Crystal Waters)'])
+        spans = lambiance.section_spans()
+        self.assertEqual([(end, d) for _, end, d in spans[-2:]],
+                         [(130, 10), (None, None)])
+        _, end, duration = partytime.section_spans(length=3000)[-1]
+        self.assertEqual((end, duration), (3000, 262))
+
+    def testParseDatetime(self):
+        for s in ['2009-08-02T16:55:01Z', '2009-08-02T16:55:01+00:00',
+                  '2009-08-02 16:55:01Z']:
+            self.assertEqual(mixcloud.parse_datetime(s),
+                             partytime.created_time)
+        with self.assertRaises(ValueError):
+            mixcloud.parse_datetime('2009-13-02T16:55:01Z')
+
     def testOauthUrl(self):
         full_url = self.o.authorize_url()
         # Check URL without parameters.
@@ -237,6 +741,40 @@ class TestMixcloud(unittest.TestCase):
         with self.assertRaises(mixcloud.MixcloudOauthError):
             self.o.exchange_token('my_code')
 
+    def testSessionSharedPool(self):
+        self.mc.register_user(spartacus)
+        sessions = []
+
+        def worker():
+            sessions.append(self.m.session)
+            self.assertEqual(self.m.user('spartacus').name, 'Spartacus')
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(sessions), 4)
+        self.assertEqual(len(set(id(s) for s in sessions)), 4)
+        adapters = set(id(s.get_adapter(self.m.api_root)) for s in sessions)
+        self.assertEqual(adapters, set([id(self.m._adapter)]))
+
+    def testContextManager(self):
+        self.mc.register_user(spartacus)
+        with mixcloud.Mixcloud(timeout=5) as m:
+            self.assertEqual(m.user('spartacus').name, 'Spartacus')
+        with mock.patch.object(m._adapter, 'close') as close:
+            m.close()
+            close.assert_called_once_with()
+
+    def testOauthExchangeSession(self):
+        self.mc.oauth_exchange()
+        o = mixcloud.MixcloudOauth(client_id=self.client_id,
+                                   client_secret=self.client_secret,
+                                   redirect_uri=self.redirect_uri,
+                                   session=self.m.session)
+        self.assertEqual(o.exchange_token('my_code'), 'my_access_token')
+
     @mock.patch('netrc.netrc.authenticators')
     @mock.patch('netrc.netrc.__init__')
     def testNetrc(self, netrc_init, netrc_authenticators):
@@ -245,3 +783,346 @@ class TestMixcloud(unittest.TestCase):
 
         m = mixcloud.Mixcloud()
         self.assertEqual(m.access_token, 'my_access_token')
+
+
+class TestMockHTTPServer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.httpretty_enabled = httpretty.is_enabled()
+        httpretty.disable()
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.httpretty_enabled:
+            httpretty.enable()
+
+    def setUp(self):
+        self.mc = MockServer(listen=True)
+        self.addCleanup(self.mc.close)
+        self.m = mixcloud.Mixcloud(api_root=self.mc.api_root,
+                                   access_token='token')
+        self.addCleanup(self.m.close)
+
+    def testUploadBatch(self):
+        self.mc.i_am(spartacus)
+        self.mc.mock_upload(spartacus)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with open('example.yml') as f:
+            example = f.read()
+        for n in range(3):
+            stem = os.path.join(tmpdir, 'show%d' % n)
+            with open(stem + '.yml', 'w') as f:
+                f.write(example.replace('Sample & Funky', 'Show %d' % n))
+            with open(stem + '.mp3', 'wb') as f:
+                f.write(b'\x00' * 1000)
+        with open(os.path.join(tmpdir, 'show1.png'), 'wb') as f:
+            f.write(b'\x00' * 10)
+
+        n_requests = self.mc.request_count('/me/')
+        reports = upload_batch(self.m, tmpdir, max_workers=2,
+                               max_bandwidth=10 ** 6)
+        self.assertEqual(self.mc.request_count('/me/') - n_requests, 1)
+        self.assertEqual([r.cloudcast.key for r in reports],
+                         ['show-0', 'show-1', 'show-2'])
+        self.assertTrue(all(r.ok and r.elapsed >= 0 for r in reports))
+        self.assertEqual([r.result.attempts for r in reports], [1, 1, 1])
+        self.assertIsNotNone(reports[1].item.picture)
+        u = self.m.user('spartacus')
+        self.assertEqual(u.cloudcast('show-2').sections()[6].start_time, 688)
+
+        os.remove(os.path.join(tmpdir, 'show0.mp3'))
+        with open(os.path.join(tmpdir, 'show1.yml'), 'w') as f:
+            f.write('title: Broken\n')
+        with self.assertRaises(BatchValidationError) as cm:
+            upload_batch(self.m, scan_directory(tmpdir))
+        self.assertEqual(len(cm.exception.errors), 2)
+
+    def testUploadMalformed(self):
+        self.mc.mock_upload(spartacus)
+        body = MultipartBody({'name': 'Show'}, {}, boundary='xyz')
+        data = body.read(len(body))
+        r = requests.post(self.mc.api_root + '/upload/', data=data[:-10],
+                          headers={'Content-Type': body.content_type})
+        self.assertEqual(r.status_code, 400)
+        self.assertIn('Truncated', r.json()['error']['message'])
+        self.assertEqual(self.mc.uploads, [])
+
+    def testHydrate(self):
+        shows = make_cloudcasts(5)
+        self.mc.register_cloudcasts(spartacus, shows)
+        u = self.m.user('spartacus')
+        ccs = u.cloudcasts()
+        ccs[0].sections()
+        # Listed but no longer available.
+        ghost = mixcloud.Cloudcast('ghost', 'Ghost', None, [], None,
+                                   spartacus, None, m=self.m)
+        n_requests = self.mc.request_count('/{user}/{cloudcast}')
+        failures = self.m.hydrate(ccs + [ghost], max_workers=3)
+        self.assertEqual(
+            self.mc.request_count('/{user}/{cloudcast}') - n_requests, 5)
+        self.assertEqual(len(failures), 1)
+        self.assertIs(failures[0][0], ghost)
+        self.assertIsInstance(failures[0][1], requests.HTTPError)
+        self.assertEqual(failures[0][1].response.status_code, 404)
+        for cc, show in zip(ccs, shows):
+            self.assertEqual(cc._description, show.description())
+            self.assertEqual(len(cc._sections), 9)
+
+    def testCloudcastsEager(self):
+        self.mc.register_cloudcasts(spartacus, make_cloudcasts(3))
+        u = self.m.user('spartacus')
+        ccs = u.cloudcasts(eager=True)
+        self.assertEqual([cc._description for cc in ccs],
+                         ['Show number 0', 'Show number 1', 'Show number 2'])
+
+    def testRoutes(self):
+        self.mc.i_am(spartacus)
+        self.mc.register_cloudcasts(spartacus, make_cloudcasts(5))
+        self.mc.mock_upload(spartacus)
+        self.mc.oauth_exchange()
+        u = self.m.me()
+        self.assertEqual(u.name, spartacus.name)
+        ccs = list(u.iter_cloudcasts(page_size=2, prefetch=0))
+        self.assertEqual([cc.key for cc in ccs],
+                         ['show-%d' % i for i in range(5)])
+        self.assertFalse(self.m.hydrate(ccs, max_workers=4))
+        self.assertEqual(ccs[4].description(), 'Show number 4')
+        mp3file = io.BytesIO(b'\x00' * 1000)
+        r = self.m.upload(partytime, mp3file)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(u.cloudcast('party-time').sections()), 9)
+        o = mixcloud.MixcloudOauth(oauth_root=self.mc.oauth_root)
+        self.assertEqual(o.exchange_token('code'), 'my_access_token')
+        self.assertEqual(self.mc.request_count('/{user}/cloudcasts/'), 3)
+        self.assertEqual(self.mc.request_count('/{user}/{cloudcast}'), 6)
+        self.assertEqual(self.mc.request_count(method='POST'), 1)
+
+    def testLargeUpload(self):
+        self.mc.i_am(spartacus)
+        self.mc.mock_upload(spartacus, hash='md5')
+        mp3 = os.urandom(1 << 16) * 64
+        r = self.m.upload(partytime, io.BytesIO(mp3))
+        self.assertEqual(r.status_code, 200)
+        mp3_field = self.mc.uploads[0]['mp3']
+        self.assertEqual(mp3_field.size, len(mp3))
+        self.assertEqual(mp3_field.digest, hashlib.md5(mp3).hexdigest())
+        self.assertEqual(self.mc.uploads[0]['sections-3-start_time'], '1061')
+        # Chunked transfer encoding.
+        body = MultipartBody(mixcloud.upload_payload(lambiance),
+                             {'mp3': io.BytesIO(mp3)})
+        r = self.m.session.post(self.mc.api_root + '/upload/',
+                                data=iter(lambda: body.read(8192), b''),
+                                headers={'Content-Type': body.content_type})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.mc.uploads[1]['mp3'].size, len(mp3))
+        self.assertEqual(self.m.user('spartacus').cloudcasts()[0].name,
+                         lambiance.name)
+
+    def testNotFound(self):
+        r = self.m.session.get(self.mc.api_root + '/nobody')
+        self.assertEqual(r.status_code, 404)
+        self.assertEqual(self.mc.request_count(None), 1)
+
+    @mock.patch('time.sleep')
+    def testInjectErrors(self, sleep):
+        self.mc.register_user(spartacus)
+        self.mc.inject_error(429, path='^/spartacus$', times=2,
+                             retry_after=3)
+        m = mixcloud.Mixcloud(api_root=self.mc.api_root,
+                              rate_limiter=RateLimiter(rate=100))
+        self.assertEqual(m.user('spartacus').name, spartacus.name)
+        self.assertEqual(self.mc.request_count('/{user}'), 3)
+        delays = [call[0][0] for call in sleep.call_args_list]
+        self.assertEqual(len(delays), 2)
+        self.assertTrue(all(2.9 < d <= 3 for d in delays))
+        self.mc.inject_error(503, times=None)
+        for _ in range(2):
+            r = m.session.get(self.mc.api_root + '/spartacus')
+            self.assertEqual(r.status_code, 503)
+
+    def testLatencyAndBandwidth(self):
+        self.mc.register_cloudcasts(spartacus, make_cloudcasts(1))
+        self.mc.set_latency(0.2, path='/cloudcasts/$')
+        self.mc.set_bandwidth(2000, path='/show-0$')
+        start = time.time()
+        self.m.user('spartacus')
+        self.assertLess(time.time() - start, 0.2)
+        start = time.time()
+        cc, = self.m.user('spartacus').cloudcasts()
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        start = time.time()
+        cc.sections()
+        # The response is about 1.5kB.
+        self.assertGreaterEqual(time.time() - start, 0.5)
+
+
+class TestTracklistIndex(unittest.TestCase):
+
+    def testIndex(self):
+        index = TracklistIndex()
+        index.add(partytime)
+        index.add(lambiance)
+        index.add(lambiance)
+        self.assertEqual(len(index), 2)
+        lamb = ('spartacus', 'lambiance')
+        self.assertEqual(index.artist('Aphex Twin'), [(lamb, 40), (lamb, 80)])
+        self.assertEqual(index.artist('aphex-twin'), [(lamb, 40), (lamb, 80)])
+        self.assertEqual(index.track('vessel'), [(lamb, 30)])
+        self.assertEqual(index.artist_prefix('jon'), [(lamb, 30), (lamb, 50)])
+        self.assertEqual(index.track_prefix('My Time'),
+                         [(('spartacus', 'party-time'), 716)])
+
+        with tempfile.TemporaryFile('w+') as f:
+            index.save(f)
+            f.seek(0)
+            loaded = TracklistIndex.load(f)
+        self.assertEqual(loaded.artist_prefix('m'), index.artist_prefix('m'))
+
+        index.remove(lambiance)
+        self.assertNotIn(lambiance, index)
+        self.assertEqual(index.artist('Aphex Twin'), [])
+        self.assertEqual(index.artist_prefix('jon'), [])
+        self.assertNotIn('four-tet', index.artists())
+        self.assertEqual(len(index.artists()), 9)
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        listed = mixcloud.Cloudcast('listed', u'Caf\xe9', None, [], None,
+                                    spartacus, partytime.created_time,
+                                    pictures={'large': 'http://x/y.jpg'})
+        with open('example.yml') as f:
+            from_yml = mixcloud.Cloudcast.from_yml(f, None)
+        self.cloudcasts = [partytime, lambiance, listed, from_yml]
+
+    def check(self, loaded):
+        self.assertEqual(len(loaded), len(self.cloudcasts))
+        for a, b in zip(self.cloudcasts, loaded):
+            self.assertEqual(b.to_json(), a.to_json())
+        self.assertEqual(loaded[0].created_time, partytime.created_time)
+        self.assertIsNone(loaded[2]._sections)
+        self.assertIsNone(loaded[3].user)
+
+    def testJsonLines(self):
+        lines = list(iter_dump_jsonl(self.cloudcasts))
+        self.assertEqual(len(lines), 4)
+        self.check(list(iter_load_jsonl(lines)))
+        self.check(list(iter_load_jsonl(lines, lazy=True)))
+
+    def testBinary(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'snapshot.bin')
+        with open(path, 'wb') as f:
+            dump_binary(self.cloudcasts * 2, f)
+        loaded = list(iter_load_binary(path))
+        self.assertEqual(len(loaded), 8)
+        self.check(loaded[4:])
+        self.assertIs(loaded[1].sections()[3].track.artist,
+                      loaded[5].sections()[3].track.artist)
+        # Stopping early releases the file.
+        for cc in iter_load_binary(path):
+            break
+
+
+class TestJsonStream(unittest.TestCase):
+
+    def testIterItems(self):
+        data = {'paging': {'next': 'http://x/?a=[1]'},
+                'data': [{'name': u'caf\xe9 "]}', 'n': 123456789},
+                         [], 3.25, None, u'\u2603'],
+                'name': 'Cloudcasts',
+                }
+        body = json.dumps(data, ensure_ascii=False, indent=1).encode('utf-8')
+        for size in [1, 3, 7, len(body)]:
+            chunks = (body[i:i + size] for i in range(0, len(body), size))
+            members = {}
+            items = list(iter_items(chunks, 'data', members))
+            self.assertEqual(items, data['data'])
+            self.assertEqual(members, {'paging': data['paging'],
+                                       'name': 'Cloudcasts'})
+        self.assertEqual(list(iter_items([b'{"data": []}'])), [])
+        self.assertEqual(list(iter_items([b'{}'])), [])
+        with self.assertRaises(ValueError):
+            list(iter_items([b'{"data": [1, 2']))
+
+    def testFirstItemEarly(self):
+        def chunks():
+            yield b'{"data": [{"a": 1}, '
+            raise AssertionError('Read too far')
+
+        self.assertEqual(next(iter_items(chunks())), {'a': 1})
+
+
+class TestMultipartBody(unittest.TestCase):
+
+    def testEncoding(self):
+        mp3 = b'ID3\r\n--not-a-boundary\r\n\x00' * 1000
+        body = MultipartBody({'name': u'Caf\xe9', 'sections-0-start_time': 0},
+                             {'mp3': io.BytesIO(mp3)},
+                             chunk_size=100)
+        data = b''
+        while True:
+            chunk = body.read(8192)
+            if not chunk:
+                break
+            self.assertLessEqual(len(chunk), 100)
+            data += chunk
+        self.assertEqual(len(data), len(body))
+        headers = 'Content-Type: {}\r\n\r\n'.format(body.content_type)
+        # message_from_bytes is message_from_string on Python 2.
+        parse = getattr(email, 'message_from_bytes',
+                        email.message_from_string)
+        msg = parse(headers.encode() + data)
+        parts = {p.get_param('name', header='content-disposition'):
+                 p.get_payload(decode=True)
+                 for p in msg.get_payload()}
+        self.assertEqual(parts['name'].decode('utf-8'), u'Caf\xe9')
+        self.assertEqual(parts['sections-0-start_time'], b'0')
+        self.assertEqual(parts['mp3'], mp3)
+        body.reset()
+        self.assertEqual(body.read(-1) + body.read(), data[:200])
+
+    def testParse(self):
+        mp3 = b'ID3\r\n--' + b'\r\n-\x00' * 1000
+        body = MultipartBody({'name': u'Caf\xe9', 'desc': u'a\r\nb\n'},
+                             {'mp3': io.BytesIO(mp3)},
+                             boundary='xyz')
+        data = body.read(len(body))
+        for chunk_size in (1, 7, 1 << 16):
+            fields = parse_multipart(data, chunk_size=chunk_size)
+            self.assertEqual(fields['name'], u'Caf\xe9')
+            self.assertEqual(fields['desc'], u'a\r\nb\n')
+            self.assertEqual(fields['mp3'].filename, 'mp3')
+            self.assertEqual(fields['mp3'].size, len(mp3))
+            self.assertIsNone(fields['mp3'].digest)
+        fields = parse_multipart(io.BytesIO(b'preamble\r\n' + data),
+                                 boundary='xyz', hash='sha1')
+        self.assertEqual(fields['mp3'].digest, hashlib.sha1(mp3).hexdigest())
+        with self.assertRaises(ValueError):
+            parse_multipart(data[:-10])
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    @mock.patch('mixcloud.ratelimit.monotonic')
+    def testReserve(self, monotonic):
+        monotonic.return_value = 0.0
+        bucket = TokenBucket(1000)
+        self.assertEqual(bucket.reserve(600), 0)
+        self.assertAlmostEqual(bucket.reserve(600), 0.2)
+        self.assertAlmostEqual(bucket.wait_time, 0.201)
+        monotonic.return_value = 1.0
+        self.assertEqual(bucket.reserve(500), 0)
+        self.assertAlmostEqual(bucket.reserve(1500), 1.2)
+
+    def testParseRetryAfter(self):
+        parse = mixcloud.ratelimit.parse_retry_after
+        self.assertEqual(parse('12'), 12)
+        self.assertIsNone(parse('soon'))
+        when = email.utils.formatdate(time.time() + 60, usegmt=True)
+        self.assertTrue(55 < parse(when) <= 60)
+        self.assertEqual(parse('Wed, 21 Oct 2015 07:28:00 GMT'), 0)